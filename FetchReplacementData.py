@@ -1,32 +1,32 @@
 import requests
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import json
 import csv
 import random
 import time
 import os
-from tqdm import tqdm
-import subprocess
 import atexit
 import signal
 import sys
-
-try:
-    import ollama
-    ollamaEnabled = True
-except ImportError:
-    print("Ollama library not found, AI features will be disabled...")
-    ollamaEnabled = False
+import threading
+import sqlite3
+import hashlib
+import queue
+import multiprocessing
+import argparse
+import re
+from dataclasses import dataclass
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+
+# The ollama library, only imported by loadOllama once AI rephrasing is turned on
+ollama = None
+ollamaEnabled = None
 
 
 # Define the file where the data will be stored
 userDataFile = 'user_data.json'
-# Check if the file exists and read the stored data if it does
-if os.path.exists(userDataFile):
-    with open(userDataFile, 'r') as f:
-        user_data = json.load(f)
-else:
-    user_data = {}
 
 # Questions and default answers from previous runs
 questions = {
@@ -39,37 +39,227 @@ questions = {
     'debug' : "Enable debugging, yes/no: "
 }
 
+# Answers a headless run can do without, the rest have to be saved or given as settings
+headlessDefaults = {
+    'ai': 'no',
+    'model': 'n/a',
+    'debug': 'no'
+}
 
-# Ask questions and allow the user to keep previous answers or update them
-for key, question in questions.items():
-    if key in user_data:
-        new_value = input(f"{question} (press Enter to keep '{user_data[key]}'): ")
-        if new_value:
-            user_data[key] = new_value  # Update value if new input is provided
-    else:
-        user_data[key] = input(question)  # Ask for the value if it's not stored
+# Advanced settings and their defaults, these are not asked for but can be changed in user_data.json
+advancedSettings = {
+    'concurrency': 5,  # Number of Service Requests fetched in parallel, 1 fetches them one at a time
+    'warrantyCacheDays': 30,  # How long Lenovo warranty lookups are reused before being fetched again, 0 disables the cache
+    'rateLimit': 100,  # Freshservice API calls per minute until the X-Ratelimit headers report the real limit
+    'retries': 6,  # Attempts for Freshservice server errors before giving up, rate limited calls always wait and retry
+    'serverFilter': 'yes',  # Use the Freshservice ticket filter endpoint to only page through Service Requests, no pages through every ticket
+    'aiWorkers': 4,  # Descriptions sent to Ollama at the same time
+    'aiBatchSize': 1,  # Short descriptions packed into one AI prompt, 1 sends each description on its own
+    'aiCache': 'yes',  # Reuse AI descriptions from previous runs, bypass skips the cache and clear empties it once
+    'aiCacheMB': 50,  # Size of the AI description cache before the least recently used entries are removed
+    'ollamaStartTimeout': 60,  # Seconds to wait for the Ollama server to answer before continuing without it
+    'aiKeepAlive': '30m',  # How long Ollama keeps the model loaded between requests
+    'pipelineDepth': 4,  # Pages of rows each export stage can get ahead of the next one
+    'connectTimeout': 10,  # Seconds to wait for Freshservice or Lenovo to accept a connection
+    'readTimeout': 60,  # Seconds to wait for Freshservice or Lenovo to send a response
+    'lenovoURL': 'https://supportapi.lenovo.com/v2.5/warranty',  # Lenovo warranty API endpoint
+    'lenovoWorkers': 4,  # Lenovo warranty requests sent at the same time
+    'lenovoBatchSize': 10,  # Serials sent together in one comma separated Lenovo request, 1 looks each one up on its own
+    'incremental': 'no',  # yes only exports tickets updated since the last export that finished
+    'resume': 'yes',  # Carry on with an export that was interrupted instead of starting again
+    'store': 'no',  # yes mirrors every fetched ticket, requested item and lookup result into the local ticket store
+    'source': 'api',  # store writes the export from the local ticket store without calling Freshservice
+    'storeFilter': {},  # Only export store rows matching these fields, e.g. {"building": "HS"}, works with building, model, asset and technician
+    'shardWorkers': 1,  # Worker processes for a sharded export, 1 exports in this process
+    'shardDays': 30,  # Days of tickets each worker process fetches at a time in a sharded export
+    'outputFormat': 'csv',  # csv, jsonl (one JSON object per line) or parquet (needs pyarrow)
+    'parquetRowGroupSize': 10000,  # Rows held in memory and written together as one Parquet row group
+    'metricsFile': 'run_metrics.json',  # JSON summary of the time spent in each stage, HTTP responses and retries, empty to turn it off
+    'prometheusFile': 'run_metrics.prom'  # The same summary as a Prometheus textfile, point it into the node_exporter textfile directory, empty to turn it off
+}
+
+# Answers and settings for this run, set up by applyUserData
+user_data = {}
+base_url = ""
+# Headless runs never prompt, pause or save user_data.json, set by main
+headless = False
+exitLock = threading.Lock()  # Held by the first thread to pause in exitScript
+# Worker processes of a sharded export have no console, the main process reports their errors, set by initShardWorker
+shardWorker = False
+
+
+def readUserData():
+    # Check if the file exists and read the stored data if it does
+    if os.path.exists(userDataFile):
+        with open(userDataFile, 'r') as f:
+            return json.load(f)
+    return {}
+
+def askUserData(overrides):
+    data = readUserData()
+
+    # Ask questions and allow the user to keep previous answers or update them
+    for key, question in questions.items():
+        if key in overrides:
+            continue  # Given on the command line or in the environment, so not asked for
+        if key in data:
+            new_value = input(f"{question} (press Enter to keep '{data[key]}'): ")
+            if new_value:
+                data[key] = new_value  # Update value if new input is provided
+        else:
+            data[key] = input(question)  # Ask for the value if it's not stored
+
+    for key, value in advancedSettings.items():
+        data.setdefault(key, value)
+
+    # Save the updated data back to the JSON file, clearing the AI cache and command line settings only apply to this run
+    with open(userDataFile, 'w') as f:
+        json.dump(dict(data, aiCache='yes') if data['aiCache'] == 'clear' else data, f, indent=4)
+
+    return dict(data, **overrides)
+
+def headlessUserData(overrides):
+    # Settings for an unattended run come from user_data.json, the environment and the command line, nothing is asked or saved
+    data = readUserData()
+    data.update(overrides)
+
+    for key, value in headlessDefaults.items():
+        data.setdefault(key, value)
+    missing = [key for key in questions if key not in data]
+    if missing:
+        print("Missing settings for a headless run: " + ", ".join(missing))
+        print("Save them in " + userDataFile + ", pass them with --set key=value or set " + ", ".join(settingEnvName(key) for key in missing))
+        sys.exit(2)
+
+    for key, value in advancedSettings.items():
+        data.setdefault(key, value)
+    return data
+
+def settingEnvName(key):
+    # The environment variable for a setting, freshserviceBaseURL is read from EXPORT_FRESHSERVICE_BASE_URL
+    return "EXPORT_" + re.sub(r'(?<=[a-z0-9])(?=[A-Z])', '_', key).upper()
+
+def parseSetting(key, value):
+    # Settings given as text, numbers and storeFilter are read as JSON so they match what user_data.json would hold
+    if key in advancedSettings and not isinstance(advancedSettings[key], str):
+        try:
+            return json.loads(value)
+        except ValueError:
+            pass
+    return value
+
+def settingOverrides(args):
+    # Environment variables first, then the command line, these win over user_data.json for this run only
+    overrides = {}
+    for key in list(questions) + list(advancedSettings):
+        value = os.environ.get(settingEnvName(key))
+        if value is not None:
+            overrides[key] = parseSetting(key, value)
+
+    if args.days is not None:
+        overrides['days'] = str(args.days)
+    if args.ai is not None:
+        overrides['ai'] = args.ai
+    for key, value in args.set:
+        overrides[key] = parseSetting(key, value)
+    return overrides
+
+def applyUserData(data):
+    # Set up this process from the answers, worker processes get them from the main process instead of asking again
+    global user_data, base_url
+
+    user_data = data
+    # Define your API endpoint and authentication details
+    base_url = str(user_data['freshserviceBaseURL']) + "api/v2/tickets"
 
-# Save the updated data back to the JSON file
-with open(userDataFile, 'w') as f:
-    json.dump(user_data, f, indent=4)
 
 # Get user's API key from text file
 file_name = "api_key.txt"
 
 # Initialize a variable to store the API key
 
-# Define your API endpoint and authentication details
-base_url = str(user_data['freshserviceBaseURL']) + "api/v2/tickets"
 password = ""
+# Tickets requested per list page, the most Freshservice allows
+perPage = 100
 
 # Get the current time and format it
 current_time = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
 
-# Define the filename with the current time appended
-csvFilename = f'output_data_{current_time}.csv'
+# The export file, output_data_<time> with the extension for outputFormat unless --output names it
+outputFilename = ''
+# The writer for outputFilename, kept open for the whole export by openOutput
+output = None
+
+# Local SQLite mirror of fetched tickets for exporting without the API
+ticketStoreFile = 'ticket_store.db'
+ticketStore = None
+ticketStoreLock = threading.Lock()
+
+# Where the last export got to, used for incremental and resumed exports
+syncStateFile = 'sync_state.json'
+syncState = {}
+# Taken off the start of a run for the next incremental run, in case the Freshservice clock is ahead of ours
+syncClockSkew = timedelta(minutes=5)
+
+# Marks the end of the pages passed between export pipeline stages
+pipelineEnd = object()
+
+# HTTP clients shared by every stage of the export, created by runExport
+freshservice = None
+lenovo = None
+# Freshservice rate budget shared with the other worker processes of a sharded export
+rateBudget = None
+
+# Asset Tag -> Serial index, built from the assets report by loadAssetIndex
+assetIndex = None
+assetIndexLock = threading.Lock()
+
+# Lenovo warranty lookups are cached on disk by serial number
+warrantyCacheFile = 'warranty_cache.db'
+warrantyCache = None
+warrantyCacheLock = threading.Lock()
+warrantyCacheStats = {'hits': 0, 'misses': 0}
+
+# Prompts for AI rephrasing
+systemRole = "You are a bot that rephrases the explanation of device damage that is provided into breif clear and concise statements. Only provide the revised statment and nothing else. Omit any parts of the statement that indicate intentional damage. If the wording is already consise do not change it much."
+batchRole = "You will be given a JSON list of statements. Reply with a JSON object of the form {\"rephrased\": [...]} holding one revised statement for each statement, in the same order."
+# Descriptions longer than this are never batched with others
+batchMaxLength = 300
+# AI descriptions from this run, keyed by the original description
+rephrasedDescriptions = {}
+
+# AI descriptions are cached on disk by model, prompt and description
+aiCacheFile = 'ai_cache.db'
+aiCache = None
+aiCacheLock = threading.Lock()
+aiCacheStats = {'hits': 0, 'misses': 0}
+
+# Timers and counters for this run, written out by writeRunMetrics when it finishes
+# timers: stage -> [seconds, calls], counters: (name, ((label, value), ...)) -> count
+runMetrics = {'timers': {}, 'counters': {}}
+runMetricsLock = threading.Lock()
+# Descriptions for the Prometheus textfile, by metric name
+metricHelp = {
+    'stage_seconds': "Seconds spent in each export stage, summed across threads",
+    'stage_calls': "Times each export stage ran",
+    'http_responses': "HTTP responses by service and status code",
+    'http_retries': "HTTP calls retried by service and reason",
+    'http_errors': "HTTP calls that failed without a response by service",
+    'ticket_pages': "Ticket list pages fetched",
+    'service_requests': "Service Requests fetched",
+    'rows_written': "Rows written to the export",
+    'cache_hits': "Cache hits by cache",
+    'cache_misses': "Cache misses by cache",
+    'run_seconds': "Wall clock seconds the export took",
+    'tickets_per_second': "Service Requests fetched per second",
+    'success': "1 if the export finished, 0 if it stopped early",
+    'last_run_timestamp_seconds': "Unix time the export started"
+}
 
 # Define Ollama process
-global ollamaProcess
+ollamaProcess = None
+# Set once the Ollama server answers, AI calls wait for it
+ollamaReady = threading.Event()
 
 def checkOllama():
     # Check if the OS is Windows using os.name
@@ -80,16 +270,29 @@ def checkOllama():
     
     # Check all conditions
     if (user_data["ai"] == "yes" and
-        ollamaEnabled == True and
+        loadOllama() and
         is_windows and
         ollama_exists):
         return True
     else:
         return False
 
+def loadOllama():
+    # Import the ollama library the first time it's needed so runs without AI start without it
+    global ollama, ollamaEnabled
+
+    if ollamaEnabled is None:
+        try:
+            import ollama
+            ollamaEnabled = True
+        except ImportError:
+            print("Ollama library not found, AI features will be disabled...")
+            ollamaEnabled = False
+    return ollamaEnabled
+
 def terminate_exe():
     """Ensure the .exe process is killed when the script exits."""
-    if ollamaProcess.poll() is None:  # Check if the process is still running
+    if ollamaProcess is not None and ollamaProcess.poll() is None:  # Check if the process is still running
         print("Terminating the exe file...")
         ollamaProcess.terminate()  # Send termination signal
         ollamaProcess.wait()  # Wait for it to fully terminate
@@ -97,6 +300,9 @@ def terminate_exe():
 
 
 def startOllama():
+    global ollamaProcess
+    import subprocess
+
     # Get the current working directory
     current_dir = os.getcwd()
 
@@ -111,8 +317,40 @@ def startOllama():
     # Register signal handlers to ensure termination on script interruption
     signal.signal(signal.SIGINT, signal_handler)  # Handles Ctrl+C
     signal.signal(signal.SIGTERM, signal_handler)  # Handles termination signals
-    for i in tqdm(range(30), desc='Starting the Llama', unit='s', bar_format='{l_bar}{bar}| {remaining}', colour="green", leave=False):
-        time.sleep(1)  # Sleep for 1 second (adjust this for finer progress)
+
+
+def ollamaURL():
+    # The local Ollama server, following OLLAMA_HOST the same way the ollama library does
+    host = os.environ.get('OLLAMA_HOST', '127.0.0.1:11434')
+    if '://' not in host:
+        host = 'http://' + host
+    return host.rstrip('/')
+
+def waitForOllama(timeout):
+    # Poll the Ollama server until it answers or the timeout runs out
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(ollamaURL() + '/api/version', timeout=1).close()
+            return True
+        except requests.exceptions.RequestException:
+            time.sleep(0.25)
+    return False
+
+def prepareOllama():
+    # Runs in the background while the Freshservice fetch starts, waits for the server then loads the model
+    if waitForOllama(float(user_data["ollamaStartTimeout"])):
+        logging("Local Llama is ready")
+    else:
+        print("Ollama did not answer within " + str(user_data["ollamaStartTimeout"]) + " seconds, AI descriptions may fail")
+    ollamaReady.set()
+
+    try:
+        # An empty prompt only loads the model, keep_alive holds it in memory for the rephrasing later on
+        ollama.generate(model=user_data["model"], prompt="", keep_alive=user_data["aiKeepAlive"])
+        logging("Loaded model " + user_data["model"])
+    except Exception as e:
+        logging("Unable to preload model: " + str(e))
 
 
 def signal_handler(sig, frame):
@@ -121,16 +359,247 @@ def signal_handler(sig, frame):
     terminate_exe()  # Clean up and terminate the exe
     sys.exit(0)
 
+def progress(*args, **kwargs):
+    # A tqdm progress bar, hidden in headless runs so scheduled logs only get the messages
+    from tqdm import tqdm
+    return tqdm(*args, disable=headless, **kwargs)
+
+def clearScreen():
+    if not headless:
+        os.system('cls' if os.name == 'nt' else 'clear')
+
+def exitScript(code=1):
+    # Give an interactive user the chance to read the error before the window closes, headless runs exit straight away
+    # When several SR threads stop at once only the first one waits for Enter
+    if not headless and not shardWorker and exitLock.acquire(blocking=False):
+        input("Press Enter to exit....")
+    sys.exit(code)
+
+def countMetric(name, amount=1, **labels):
+    key = (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+    with runMetricsLock:
+        runMetrics['counters'][key] = runMetrics['counters'].get(key, 0) + amount
+
+def timeMetric(stage, seconds, calls=1):
+    with runMetricsLock:
+        timer = runMetrics['timers'].setdefault(stage, [0.0, 0])
+        timer[0] += seconds
+        timer[1] += calls
+
+@contextmanager
+def stageTimer(stage):
+    # Time the code inside the with block as one call of this export stage
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timeMetric(stage, time.perf_counter() - start)
+
 def logging(*args):
     if user_data['debug'] == 'yes':
         message = ' '.join(str(arg) for arg in args)
         print(message)
 
-def coolDown(cooldownTime):
+class RateLimiter:
+    """Token bucket shared by every Freshservice call, kept in step with the X-Ratelimit headers.
+
+    The bucket lives in a plain list, or in the shared memory from sharedRateBudget so the
+    worker processes of a sharded export all draw from the same budget.
+    """
+
+    def __init__(self, limit, period=60, shared=None):
+        if shared is None:
+            self.lock = threading.Lock()
+            self.state = [float(limit), float(limit), time.monotonic(), 0.0]
+        else:
+            self.state, self.lock = shared
+        self.period = period
+
+    # capacity, tokens, last refill time and the end of any Retry-After pause
+    capacity = property(lambda self: self.state[0], lambda self, value: self.state.__setitem__(0, value))
+    tokens = property(lambda self: self.state[1], lambda self, value: self.state.__setitem__(1, value))
+    updated = property(lambda self: self.state[2], lambda self, value: self.state.__setitem__(2, value))
+    blockedUntil = property(lambda self: self.state[3], lambda self, value: self.state.__setitem__(3, value))
+
+    @property
+    def rate(self):
+        return self.capacity / self.period  # Tokens added back per second
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        # Take a token, only sleeping when the budget for this minute is used up
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.blockedUntil:
+                    wait = self.blockedUntil - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            timeMetric('freshservice_rate_limit_wait', wait)
+
+    def update(self, response):
+        # Follow the limits Freshservice reports so we never run ahead of the real budget
+        total = response.headers.get('X-Ratelimit-Total')
+        remaining = response.headers.get('X-Ratelimit-Remaining')
+        with self.lock:
+            self._refill(time.monotonic())
+            if total is not None and total.isdigit() and int(total) > 0:
+                self.capacity = float(total)
+            if remaining is not None and remaining.isdigit():
+                self.tokens = min(self.tokens, float(remaining))
+
+    def pause(self, seconds):
+        # Stop every caller until the server says we can continue
+        with self.lock:
+            self.blockedUntil = max(self.blockedUntil, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+
+def sharedRateBudget(limit):
+    # Rate limiter state and lock that can be handed to worker processes
+    state = multiprocessing.Array('d', [float(limit), float(limit), time.monotonic(), 0.0], lock=False)
+    return state, multiprocessing.Lock()
+
+def retryAfterSeconds(response, default=60):
+    retryAfter = response.headers.get('Retry-After', '')
+    if retryAfter.isdigit():
+        return int(retryAfter)
+    return default
+
+def mountPool(session, poolSize):
+    # Keep-alive connection pool big enough for every worker that shares the session
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolSize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+
+
+class FreshserviceClient:
+    """Pooled keep-alive session for the Freshservice API, shared by every stage of the export."""
+
+    def __init__(self, apiKey, poolSize, retries, timeout, rateLimit, sharedBudget=None):
+        self.session = requests.Session()
+        self.session.auth = (apiKey, password)
+        mountPool(self.session, poolSize)
+        self.retries = retries
+        self.timeout = timeout  # (connect, read) seconds so no call can hang forever
+        self.rateLimiter = RateLimiter(rateLimit, shared=sharedBudget)
+
+    def get(self, url, params=None):
+        # Send a GET to Freshservice through the shared rate limiter
+        # 429s wait for Retry-After, 5xx and connection errors back off exponentially, anything else is returned to the caller
+        attempt = 0
+        while True:
+            self.rateLimiter.acquire()
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+            except requests.exceptions.RequestException as err:
+                countMetric('http_errors', service='freshservice')
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                countMetric('http_retries', service='freshservice', reason='connection_error')
+                logging("Connection error: " + str(err))
+            else:
+                countMetric('http_responses', service='freshservice', status=response.status_code)
+                self.rateLimiter.update(response)
+                if response.status_code == 429:
+                    waitTime = retryAfterSeconds(response)
+                    logging("Rate limited by Freshservice, waiting " + str(waitTime) + "s")
+                    countMetric('http_retries', service='freshservice', reason='rate_limited')
+                    self.rateLimiter.pause(waitTime)
+                    response.close()
+                    continue
+                if response.status_code < 500:
+                    return response
+                attempt += 1
+                if attempt > self.retries:
+                    return response
+                countMetric('http_retries', service='freshservice', reason='server_error')
+                logging("Error: " + str(response.status_code))
+                response.close()
+
+            # Exponential backoff with jitter, capped at a minute
+            backoff = min(60, 0.5 * 2 ** attempt) * random.uniform(0.5, 1)
+            time.sleep(backoff)
+            timeMetric('freshservice_backoff', backoff)
+
+    def close(self):
+        self.session.close()
+
+
+class LenovoWarrantyClient:
+    """Pooled keep-alive session for the Lenovo warranty API."""
+
+    def __init__(self, url, clientID, poolSize, timeout, attempts=3):
+        self.url = url
+        self.session = requests.Session()
+        self.session.headers['ClientID'] = clientID
+        mountPool(self.session, poolSize)
+        self.timeout = timeout
+        self.attempts = attempts
+
+    def lookup(self, serials):
+        # Looks up a batch of serials with one comma separated request, returning {serial: warranty data}
+        # Serials missing from the reply are left out, and None means every attempt failed
+        # A single serial whose reply has no InWarranty is retried, the same as a failed request
+        byReplySerial = {serial.upper(): serial for serial in serials}
+        found = None
+        retryReason = None  # Why the last attempt failed, for the retry counts
+        for attempt in range(self.attempts):
+            if attempt:
+                countMetric('http_retries', service='lenovo', reason=retryReason)
+                # Exponential backoff with jitter between attempts
+                backoff = 0.5 * 2 ** attempt * random.uniform(0.5, 1)
+                time.sleep(backoff)
+                timeMetric('lenovo_backoff', backoff)
+            retryReason = 'connection_error'
+            try:
+                with stageTimer('lenovo_request'):
+                    response = self.session.get(self.url, params={"Serial": ",".join(serials)}, timeout=self.timeout)
+                countMetric('http_responses', service='lenovo', status=response.status_code)
+                if response.status_code == 429:
+                    waitTime = retryAfterSeconds(response, default=5)
+                    logging("Rate limited by Lenovo, waiting " + str(waitTime) + "s")
+                    retryReason = 'rate_limited'
+                    time.sleep(waitTime)
+                    timeMetric('lenovo_rate_limit_wait', waitTime)
+                    continue
+                retryReason = 'error_status'
+                response.raise_for_status()
+                retryReason = 'bad_reply'
+                data = response.json()
+            except (requests.exceptions.RequestException, ValueError):
+                logging("Lenovo API Error")
+                if retryReason == 'connection_error':
+                    countMetric('http_errors', service='lenovo')
+                continue
 
-    # Create a progress bar that spans `total_duration` seconds
-    for i in tqdm(range(cooldownTime), desc='Waiting for API Cooldown', unit='s', bar_format='{l_bar}{bar}| {remaining}', colour="red", leave=False):
-        time.sleep(1)  # Sleep for 1 second (adjust this for finer progress)
+            # One serial gets a single object back, several get a list of them
+            found = {}
+            for reply in (data if isinstance(data, list) else [data]):
+                if not isinstance(reply, dict):
+                    continue
+                serial = byReplySerial.get(str(reply.get('Serial', '')).upper())
+                if serial is None and len(serials) == 1:
+                    serial = serials[0]
+                if serial is not None:
+                    found[serial] = reply
+            if len(serials) > 1 or found.get(serials[0], {}).get('InWarranty') is not None:
+                return found
+            retryReason = 'incomplete_reply'
+        return found
+
+    def close(self):
+        self.session.close()
 
 
 def readAPIKey():
@@ -146,24 +615,20 @@ def readAPIKey():
             return fileKey
         else:
             print("API key is empty. Make sure the file contains the API key.")
-            input("Press Enter to exit....")
-            exit()
+            exitScript()
     except FileNotFoundError:
         print(f"File '{file_name}' not found. Make sure the file is in the same directory as your Python script.")
-        input("Press Enter to exit....")
-        exit()
+        exitScript()
     except Exception as e:
         print("An error occurred:", str(e))
-        input("Press Enter to exit....")
-        exit()
+        exitScript()
 
 def rephraseText(inputString):
-    systemRole = "You are a bot that rephrases the explanation of device damage that is provided into breif clear and concise statements. Only provide the revised statment and nothing else. Omit any parts of the statement that indicate intentional damage. If the wording is already consise do not change it much."
-    
-    response = ollama.chat(model=user_data["model"], messages=[
-    {"role": "system", "content": systemRole},
-    {"role": "user", "content": str(inputString)},
-    ])
+    with stageTimer('ai_prompt'):
+        response = ollama.chat(model=user_data["model"], keep_alive=user_data["aiKeepAlive"], messages=[
+        {"role": "system", "content": systemRole},
+        {"role": "user", "content": str(inputString)},
+        ])
     logging("-----------------------------")
     logging("Original Description: ")
     logging(inputString)
@@ -173,318 +638,1156 @@ def rephraseText(inputString):
     logging("-----------------------------")
     return response['message']['content']
 
-def createCSVFile():
+def rephraseBatch(inputStrings):
+    # Rephrase several short descriptions with one prompt, falling back to one call each if the reply doesn't line up
+    if len(inputStrings) == 1:
+        return [rephraseText(inputStrings[0])]
 
-    # Open the file in write mode ('w'), which creates the file if it doesn't exist
-    with open(csvFilename, mode='w', newline='') as file:
-        writer = csv.writer(file)
-        
-        # Writing header (optional)
-        if user_data["ai"] == "yes":
-            writer.writerow(["Replacement Date", "Item", "Category" , "Sub_Category", "Item_Category", "Model", "Building", "Service Request", "Technician", "Asset Number", "Serial", "Warranty Status","Username", "Full Description", "AI Description"])
+    try:
+        with stageTimer('ai_prompt'):
+            response = ollama.chat(model=user_data["model"], format="json", keep_alive=user_data["aiKeepAlive"], messages=[
+            {"role": "system", "content": systemRole + " " + batchRole},
+            {"role": "user", "content": json.dumps(inputStrings)},
+            ])
+        rephrased = json.loads(response['message']['content'])['rephrased']
+        if isinstance(rephrased, list) and len(rephrased) == len(inputStrings) and all(isinstance(text, str) for text in rephrased):
+            for original, revised in zip(inputStrings, rephrased):
+                logging("Original Description: ", original)
+                logging("AI Description: ", revised)
+            return rephrased
+    except (ValueError, KeyError, TypeError):
+        pass
+
+    logging("AI batch reply didn't match the descriptions, rephrasing them one at a time")
+    return [rephraseText(inputString) for inputString in inputStrings]
+
+def openAICache():
+    # Open the AI description cache database, creating it on the first run
+    global aiCache
+
+    if aiCache is None:
+        aiCache = sqlite3.connect(aiCacheFile, check_same_thread=False)
+        aiCache.execute("CREATE TABLE IF NOT EXISTS ai (key TEXT PRIMARY KEY, description TEXT, size INTEGER, last_used REAL)")
+        if user_data["aiCache"] == "clear":
+            aiCache.execute("DELETE FROM ai")
+            print("AI description cache cleared")
+        trimAICache(aiCache)
+        aiCache.commit()
+    return aiCache
+
+def trimAICache(cache):
+    # Drop the least recently used AI descriptions while the cache is over its size limit
+    maxSize = float(user_data["aiCacheMB"]) * 1024 * 1024
+    totalSize = cache.execute("SELECT COALESCE(SUM(size), 0) FROM ai").fetchone()[0]
+    if totalSize > maxSize:
+        for key, size in cache.execute("SELECT key, size FROM ai ORDER BY last_used").fetchall():
+            if totalSize <= maxSize:
+                break
+            cache.execute("DELETE FROM ai WHERE key = ?", (key,))
+            totalSize -= size
+
+def aiCacheKey(description):
+    # The model and prompt are part of the key so changing either one misses the old entries
+    normalized = ' '.join(description.split())
+    return hashlib.sha256(json.dumps([user_data["model"], systemRole, normalized]).encode('utf-8')).hexdigest()
+
+def readAICache(descriptions):
+    # Returns the cached AI descriptions for any of the descriptions that have one
+    if user_data["aiCache"] == "bypass":
+        return {}
+
+    cached = {}
+    with aiCacheLock:
+        cache = openAICache()
+        for description in descriptions:
+            key = aiCacheKey(description)
+            row = cache.execute("SELECT description FROM ai WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                cached[description] = row[0]
+                cache.execute("UPDATE ai SET last_used = ? WHERE key = ?", (time.time(), key))
+        cache.commit()
+        aiCacheStats['hits'] += len(cached)
+        aiCacheStats['misses'] += len(descriptions) - len(cached)
+    return cached
+
+def writeAICache(rephrased):
+    # Save new AI descriptions, keeping the cache under its size limit
+    if user_data["aiCache"] == "bypass" or not rephrased:
+        return
+
+    with aiCacheLock:
+        cache = openAICache()
+        now = time.time()
+        cache.executemany("INSERT OR REPLACE INTO ai VALUES (?, ?, ?, ?)", [
+            (aiCacheKey(original), revised, len(original.encode('utf-8')) + len(revised.encode('utf-8')), now)
+            for original, revised in rephrased.items()
+        ])
+        trimAICache(cache)
+        cache.commit()
+
+def rephraseDescriptions(descriptions):
+    # Rephrase a list of descriptions in parallel, returning the AI descriptions in the same order
+    # Descriptions already rephrased during this run are reused instead of being sent again
+    pending = [text for text in dict.fromkeys(descriptions) if text not in rephrasedDescriptions]
+
+    # Then reuse anything rephrased on a previous run
+    cached = readAICache(pending)
+    rephrasedDescriptions.update(cached)
+    pending = [text for text in pending if text not in cached]
+
+    # Short descriptions can share a prompt when batching is turned on, long ones are always sent alone
+    batchSize = max(1, int(user_data["aiBatchSize"]))
+    batches = []
+    shortBatch = []
+    for text in pending:
+        if batchSize > 1 and len(text) <= batchMaxLength:
+            shortBatch.append(text)
+            if len(shortBatch) == batchSize:
+                batches.append(shortBatch)
+                shortBatch = []
         else:
-            writer.writerow(["Replacement Date", "Item", "Category" , "Sub_Category", "Item_Category", "Model", "Building", "Service Request", "Technician", "Asset Number", "Serial", "Warranty Status","Username", "Full Description"])
+            batches.append([text])
+    if shortBatch:
+        batches.append(shortBatch)
 
-def randomSleep():
-    time.sleep(random.uniform(0.1,0.6))
+    if pending:
+        loadOllama()
+        ollamaReady.wait()
 
-def get_serial_from_asset_tag(asset_tag):
-    # Find the CSV file
-    current_dir = os.getcwd()
-    files = os.listdir(current_dir)
-    
-    csv_files = [f for f in files if 'assets-report' in f.lower() and f.lower().endswith('.csv')]
+    with ThreadPoolExecutor(max_workers=max(1, int(user_data["aiWorkers"]))) as executor:
+        for batch, rephrased in progress(zip(batches, executor.map(rephraseBatch, batches)), desc="Revising Descriptions With AI", unit="Prompt", colour="green", leave=False, total=len(batches)):
+            rephrasedDescriptions.update(zip(batch, rephrased))
+            writeAICache(dict(zip(batch, rephrased)))
 
-    if not csv_files:
-        print("Error: No CSV file containing 'asset-report' found in the current directory.")
-        sys.exit(1)  # Exit the script
+    return [rephrasedDescriptions[text] for text in descriptions]
 
-    csv_file = csv_files[0]  # Use the first matching file
+def outputColumns():
+    header = ["Replacement Date", "Item", "Category" , "Sub_Category", "Item_Category", "Model", "Building", "Service Request", "Technician", "Asset Number", "Serial", "Warranty Status","Username", "Full Description"]
+    if user_data["ai"] == "yes":
+        header.append("AI Description")
+    return header
 
-    # Try to open the CSV file
-    try:
-        with open(csv_file, 'r', newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            # Ensure required fields are present
-            if 'Asset Tag' not in reader.fieldnames or 'Serial' not in reader.fieldnames:
-                logging("Error: CSV file does not contain 'Asset Tag' and 'Serial' fields.")
-
-            # Search for the asset tag
-            for row in reader:
-                if row.get('Asset Tag') == asset_tag:
-                    return row.get('Serial')
-            # Asset tag not found
-            logging("Warning: Asset tag not found in the CSV.")
-            return None
-    except IOError:
-        logging("Error: Cannot read file csv file for serial number lookup. It may be open or inaccessible.")
-
-def get_warranty_status(serial_number):
-    url = f"https://supportapi.lenovo.com/v2.5/warranty?Serial={serial_number}"
-    headers = {
-        "ClientID": user_data["lenovoKey"]  # Replace with your actual Client ID
-    }
 
-    rerunLookup = True
-    errorCount = 0
+class CSVOutput:
+    """CSV export written through one buffered UTF-8 handle for the whole run."""
 
-    while rerunLookup:
+    extension = '.csv'
 
+    def __init__(self, filename, columns, append=False):
+        # utf-8-sig starts new files with a byte order mark so Excel reads them as UTF-8, appending doesn't add another one
+        self.file = open(filename, mode='a' if append else 'w', newline='', encoding='utf-8-sig', buffering=1024 * 1024)
+        self.writer = csv.writer(self.file)
+        if not append:
+            self.writer.writerow(columns)
 
-        try:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            data = response.json()
-
-            if data.get('InWarranty') is not None:
-                in_warranty = data['InWarranty']
-                if in_warranty:
-                    # Find the warranty with the latest 'End' date
-                    warranties = data.get('Warranty', [])
-                    if warranties:
-                        latest_end_date = max(
-                            datetime.strptime(w['End'], "%Y-%m-%dT%H:%M:%SZ")
-                            for w in warranties
-                        )
-                        today = datetime.now()
-                        delta = latest_end_date - today
-                        months_left = delta.days // 30  # Approximate months left
-                        rerunLookup = False
-                        return f"In warranty: {months_left} months left"
-                    else:
-                        rerunLookup = False
-                        return "In warranty: Warranty details not available"
-                else:
-                    rerunLookup = False
-                    return "Out of Warranty"
-            else:
-                errorCount += 1
-                if errorCount == 3:
-                    rerunLookup = False
-                    return "Error: Invalid response data"
+    def write(self, rows):
+        self.writer.writerows(rows)
 
-        except requests.exceptions.RequestException as err:
-            errorCount += 1
+    def flush(self):
+        self.file.flush()
 
-            if errorCount == 3:
-                rerunLookup = False
-                logging("Lenovo API Error")
+    def close(self, complete=True):
+        self.file.close()
 
-                return "Error: Unable to retrieve warranty status"
 
-def fetchReplacementData(days: int):
-    api_Key = user_data["apiKey"]
-    # Calculate the date 30 days ago
-    end_date = datetime.now()
-    start_date = end_date - timedelta(days=days)
+class JSONLOutput:
+    """One JSON object per row keyed by column name, written through one buffered UTF-8 handle for the whole run."""
 
-    # Format the date strings in ISO 8601 format
-    end_date_str = end_date.strftime("%Y-%m-%dT%H:%M:%S")
-    start_date_str = start_date.strftime("%Y-%m-%dT%H:%M:%S")
+    extension = '.jsonl'
 
-    logging("Exporting data from past " + str(days) + " days")
+    def __init__(self, filename, columns, append=False):
+        self.columns = columns
+        self.file = open(filename, mode='a' if append else 'w', encoding='utf-8', buffering=1024 * 1024)
 
-    pageList = []
+    def write(self, rows):
+        self.file.writelines(json.dumps(dict(zip(self.columns, row)), ensure_ascii=False) + "\n" for row in rows)
 
-    for x in range(1001):
-        pageList.append(x)
+    def flush(self):
+        self.file.flush()
 
-    pageList.remove(0)
-    # print(pageList)
+    def close(self, complete=True):
+        self.file.close()
 
-    blankPageCount = 0
 
-    os.system('cls' if os.name == 'nt' else 'clear')
-    for page in tqdm(pageList, desc="Processing Ticket Pages", unit="Page"):
-        randomSleep()
-        service_request_ids = []
-        # Define the parameters for the API request
-        params = {
-        "updated_since": start_date_str,
-        "per_page": 100,
-        "page": page
-        }
+class ParquetOutput:
+    """Parquet export with string columns, rows are buffered and written parquetRowGroupSize at a time as row groups.
 
-        # Send the GET request with basic authentication
+    The file is written as <name>.partial and only renamed once it is complete, a Parquet file can't be
+    appended to, so an interrupted export is thrown away and starts over on the next run.
+    """
 
-        response = requests.get(base_url, params=params, auth=(api_Key, password))
-        reRunPageFetch = True
+    extension = '.parquet'
 
+    def __init__(self, filename, columns, append=False):
+        import pyarrow
+        import pyarrow.parquet
 
-        while reRunPageFetch:
-            if response.status_code == 200:
-                reRunPageFetch = False
-                try:
-                    data = response.json()['tickets']  # Try to parse the JSON response
-                    # print(data)
-                except json.decoder.JSONDecodeError:
-                    print("Unable to parse the JSON response")
-                    data = []  # Set data as an empty list if parsing fails
-                    input("Press Enter to exit....")
-                    exit()
-            else:
-                # response.close()
-                logging("Waiting for API cooldown")
-                # time.sleep(30)
-                coolDown(60)
+        self.pyarrow = pyarrow
+        self.filename = filename
+        self.partialFile = filename + '.partial'
+        self.schema = pyarrow.schema([(column, pyarrow.string()) for column in columns])
+        self.writer = pyarrow.parquet.ParquetWriter(self.partialFile, self.schema)
+        self.rowGroupSize = max(1, int(user_data["parquetRowGroupSize"]))
+        self.rows = []
 
-        logging("Fetching Data from Freshservice page: "+  str(page))
-        for ticket in data:
-                if isinstance(ticket, dict) and ticket.get("type") == "Service Request":
-                    service_request_ids.append(ticket["id"])
-
-        if service_request_ids == []:
-            logging("No valid SRs on current page...")
-            blankPageCount += 1
-            if blankPageCount == 75:
-                print("Encountered 50 consecutive blank ticket pages, exiting script...")
-                break
-            else:
-                continue
-        blankPageCount = 0
+    def write(self, rows):
+        self.rows.extend(rows)
+        while len(self.rows) >= self.rowGroupSize:
+            self.writeRowGroup(self.rows[:self.rowGroupSize])
+            self.rows = self.rows[self.rowGroupSize:]
+
+    def writeRowGroup(self, rows):
+        columns = [self.pyarrow.array([None if row[index] is None else str(row[index]) for row in rows], type=self.pyarrow.string())
+                   for index in range(len(self.schema))]
+        self.writer.write_table(self.pyarrow.Table.from_arrays(columns, schema=self.schema), row_group_size=len(rows))
+
+    def flush(self):
+        pass  # Rows wait for a full row group, the file isn't usable until it's closed anyway
+
+    def close(self, complete=True):
+        if complete and self.rows:
+            self.writeRowGroup(self.rows)
+        self.rows = []
+        self.writer.close()
+        if complete:
+            os.replace(self.partialFile, self.filename)
+        else:
+            os.remove(self.partialFile)
+
+
+outputTypes = {
+    'csv': CSVOutput,
+    'jsonl': JSONLOutput,
+    'parquet': ParquetOutput
+}
+
+def defaultOutputFilename():
+    return 'output_data_' + current_time + outputTypes.get(user_data["outputFormat"], CSVOutput).extension
+
+def openOutput(outputFormat=None, append=False):
+    # Open outputFilename for this export, appending to it when an interrupted export is resumed
+    global output
+
+    outputFormat = outputFormat or user_data["outputFormat"]
+    if outputFormat not in outputTypes:
+        print("Unknown outputFormat '" + str(outputFormat) + "', use one of: " + ", ".join(outputTypes))
+        exitScript()
+    try:
+        output = outputTypes[outputFormat](outputFilename, outputColumns(), append)
+    except ImportError:
+        print("pyarrow library not found, install it with 'pip install pyarrow' to export Parquet files...")
+        exitScript()
+    except PermissionError:
+        print("Please close or delete the " + outputFilename + " file...")
+        exitScript()
+    return output
+
+def closeOutput(complete=True):
+    # Finish the export file, an incomplete Parquet file is removed
+    global output
+
+    if output is not None:
+        output.close(complete)
+        output = None
+
+def findAssetReport():
+    # Find the assets report CSV file in the current directory
+    current_dir = os.getcwd()
+    files = os.listdir(current_dir)
+    
+    csv_files = [f for f in files if 'assets-report' in f.lower() and f.lower().endswith('.csv')]
+
+    if not csv_files:
+        print("Error: No CSV file containing 'asset-report' found in the current directory.")
+        sys.exit(1)  # Exit the script
+
+    return csv_files[0]  # Use the first matching file
+
+def loadAssetIndex():
+    # Build the Asset Tag -> Serial index once per run, reusing the sidecar index file if the report hasn't changed
+    global assetIndex
+
+    with assetIndexLock:
+        if assetIndex is not None:
+            return assetIndex
+
+        csv_file = findAssetReport()
+        indexFile = os.path.splitext(csv_file)[0] + '.index.json'
+        reportStat = os.stat(csv_file)
+
+        # The sidecar index is only valid for the exact report it was built from
+        try:
+            with open(indexFile, 'r') as f:
+                savedIndex = json.load(f)
+            if (savedIndex.get('report') == csv_file and
+                savedIndex.get('mtime') == reportStat.st_mtime and
+                savedIndex.get('size') == reportStat.st_size):
+                logging("Loaded asset index from " + indexFile)
+                assetIndex = savedIndex['index']
+                return assetIndex
+        except (IOError, ValueError, AttributeError, KeyError):
+            pass
+
+        # Try to open the CSV file
+        try:
+            with open(csv_file, 'r', newline='') as csvfile:
+                reader = csv.DictReader(csvfile)
+                # Ensure required fields are present
+                if 'Asset Tag' not in reader.fieldnames or 'Serial' not in reader.fieldnames:
+                    logging("Error: CSV file does not contain 'Asset Tag' and 'Serial' fields.")
+
+                newIndex = {}
+                for row in reader:
+                    # Keep the first row for an asset tag, the same one the old linear search returned
+                    newIndex.setdefault(row.get('Asset Tag'), row.get('Serial'))
+        except IOError:
+            logging("Error: Cannot read file csv file for serial number lookup. It may be open or inaccessible.")
+            return {}
+
+        assetIndex = newIndex
+        logging("Indexed " + str(len(assetIndex)) + " assets from " + csv_file)
+
+        try:
+            with open(indexFile, 'w') as f:
+                json.dump({'report': csv_file, 'mtime': reportStat.st_mtime, 'size': reportStat.st_size, 'index': assetIndex}, f)
+        except IOError:
+            logging("Warning: Unable to save the asset index to " + indexFile)
+
+        return assetIndex
+
+def get_serial_from_asset_tag(asset_tag):
+    serial = loadAssetIndex().get(asset_tag)
+    if serial is None:
+        # Asset tag not found
+        logging("Warning: Asset tag not found in the CSV.")
+    return serial
+
+def openWarrantyCache():
+    # Open the warranty cache database, creating it on the first run
+    global warrantyCache
+
+    if warrantyCache is None:
+        warrantyCache = sqlite3.connect(warrantyCacheFile, check_same_thread=False)
+        warrantyCache.execute("CREATE TABLE IF NOT EXISTS warranty (serial TEXT PRIMARY KEY, in_warranty INTEGER, end_dates TEXT, fetched_at REAL)")
+        warrantyCache.commit()
+    return warrantyCache
+
+def readWarrantyCache(serial_number):
+    # Returns the cached (in_warranty, end_dates) for a serial, or None if it isn't cached or has expired
+    maxAge = float(user_data["warrantyCacheDays"]) * 86400
+    with warrantyCacheLock:
+        row = openWarrantyCache().execute("SELECT in_warranty, end_dates, fetched_at FROM warranty WHERE serial = ?", (serial_number,)).fetchone()
+        if row is not None and time.time() - row[2] < maxAge:
+            warrantyCacheStats['hits'] += 1
+            return bool(row[0]), json.loads(row[1])
+        warrantyCacheStats['misses'] += 1
+        return None
+
+def writeWarrantyCache(serial_number, in_warranty, end_dates):
+    with warrantyCacheLock:
+        cache = openWarrantyCache()
+        cache.execute("INSERT OR REPLACE INTO warranty VALUES (?, ?, ?, ?)", (serial_number, int(in_warranty), json.dumps(end_dates), time.time()))
+        cache.commit()
+
+def formatWarrantyStatus(in_warranty, end_dates):
+    # Months left is worked out from the raw end dates each time so cached entries stay correct
+    if not in_warranty:
+        return "Out of Warranty"
+    if not end_dates:
+        return "In warranty: Warranty details not available"
+
+    # Find the warranty with the latest 'End' date, the dates are ISO 8601 so the latest also sorts last as text
+    latest_end_date = datetime.strptime(max(end_dates), "%Y-%m-%dT%H:%M:%SZ")
+    today = datetime.now()
+    if latest_end_date < today:
+        return "Out of Warranty"
+    delta = latest_end_date - today
+    months_left = delta.days // 30  # Approximate months left
+    return f"In warranty: {months_left} months left"
+
+def warrantyStatusFromReply(serial_number, data):
+    # Turn a Lenovo reply into the warranty status text, caching the end dates for next time
+    if data is None:
+        return "Error: Unable to retrieve warranty status"
+    if data.get('InWarranty') is None:
+        return "Error: Invalid response data"
+
+    in_warranty = bool(data['InWarranty'])
+    end_dates = [w['End'] for w in data.get('Warranty', []) or []]
+    writeWarrantyCache(serial_number, in_warranty, end_dates)
+    return formatWarrantyStatus(in_warranty, end_dates)
+
+def lookupWarrantyBatch(serials):
+    # Look up serials that aren't cached in one Lenovo request, returning {serial: warranty status}
+    replies = lenovo.lookup(serials)
+    if replies is None:
+        # The request already used its retries, trying each serial on its own would only make more failing calls
+        return {serial: warrantyStatusFromReply(serial, None) for serial in serials}
+    statuses = {}
+    for serial in serials:
+        data = replies.get(serial)
+        if len(serials) > 1 and (data is None or data.get('InWarranty') is None):
+            # Anything the batch reply didn't answer gets a request of its own
+            statuses.update(lookupWarrantyBatch([serial]))
+        else:
+            statuses[serial] = warrantyStatusFromReply(serial, data)
+    return statuses
+
+def lookupWarranties(serials, executor):
+    # Warranty status for each serial, from the cache where possible and otherwise from Lenovo
+    # in batches of lenovoBatchSize serials looked up concurrently on the executor
+    statuses = {}
+    missing = []
+    for serial in dict.fromkeys(serials):
+        cachedWarranty = readWarrantyCache(serial)
+        if cachedWarranty is not None:
+            statuses[serial] = formatWarrantyStatus(*cachedWarranty)
+        else:
+            missing.append(serial)
+
+    batchSize = max(1, int(user_data["lenovoBatchSize"]))
+    batches = [missing[start:start + batchSize] for start in range(0, len(missing), batchSize)]
+    for batchStatuses in executor.map(lookupWarrantyBatch, batches):
+        statuses.update(batchStatuses)
+    return statuses
+
+def openTicketStore():
+    # Open the local ticket store, creating its tables and indexes on the first run
+    global ticketStore
+
+    if ticketStore is None:
+        ticketStore = sqlite3.connect(ticketStoreFile, check_same_thread=False)
+        ticketStore.executescript("""
+            CREATE TABLE IF NOT EXISTS tickets (id INTEGER PRIMARY KEY, updated_at TEXT, category TEXT, sub_category TEXT, item_category TEXT, ticket TEXT);
+            CREATE TABLE IF NOT EXISTS requested_items (ticket_id INTEGER PRIMARY KEY, service_item_id INTEGER, created_at TEXT, asset TEXT, building TEXT, model TEXT, item TEXT, technician TEXT, username TEXT, description TEXT, custom_fields TEXT);
+            CREATE TABLE IF NOT EXISTS enrichment (ticket_id INTEGER PRIMARY KEY, serial TEXT, warranty TEXT, ai_description TEXT);
+            CREATE INDEX IF NOT EXISTS requested_items_created_at ON requested_items (created_at);
+            CREATE INDEX IF NOT EXISTS requested_items_building ON requested_items (building);
+            CREATE INDEX IF NOT EXISTS requested_items_model ON requested_items (model);
+            CREATE INDEX IF NOT EXISTS requested_items_asset ON requested_items (asset);
+            CREATE INDEX IF NOT EXISTS requested_items_technician ON requested_items (technician);
+        """)
+        ticketStore.commit()
+    return ticketStore
+
+def storeTicket(ticket, item):
+    # Mirror a ticket and its requested item into the store, newer fetches replace older ones
+    custom_fields = item.get('custom_fields') or {}
+    with ticketStoreLock:
+        store = openTicketStore()
+        store.execute("INSERT OR REPLACE INTO tickets VALUES (?, ?, ?, ?, ?, ?)", (
+            ticket["id"], ticket.get('updated_at'), ticket.get('category'), ticket.get('sub_category'), ticket.get('item_category'), json.dumps(ticket)))
+        store.execute("INSERT OR REPLACE INTO requested_items VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+            ticket["id"], item.get('service_item_id'), item.get('created_at'), custom_fields.get('asset'), custom_fields.get('building'),
+            custom_fields.get('model'), custom_fields.get('item'), custom_fields.get('technician_initials'),
+            custom_fields.get('student_username'), custom_fields.get('full_issue_description'), json.dumps(custom_fields)))
+        store.commit()
+
+def storeRows(rows):
+    # Save the serial, warranty and AI description worked out for each row
+    with ticketStoreLock:
+        store = openTicketStore()
+        store.executemany("INSERT OR REPLACE INTO enrichment VALUES (?, ?, ?, ?)", [
+            (int(row.srNumber), row.serial, row.warranty, row.aiDescription) for row in rows])
+        store.commit()
+
+def exportFromStore(days):
+    # Write the CSV from the local store without calling any API, storeFilter narrows it down by building, model, asset or technician
+    # created_at is stored in UTC, the same as the API export's window
+    since = (utcNow() - timedelta(days=days)).strftime("%Y-%m-%dT%H:%M:%S")
+    query = """
+        SELECT r.created_at, r.item, t.category, t.sub_category, t.item_category, r.model, r.building, r.ticket_id, r.technician,
+               r.asset, r.username, r.description, e.serial, e.warranty, e.ai_description
+        FROM requested_items r JOIN tickets t ON t.id = r.ticket_id LEFT JOIN enrichment e ON e.ticket_id = r.ticket_id
+        WHERE r.service_item_id = 47 AND r.created_at >= ?"""
+    params = [since]
+    for column, value in (user_data["storeFilter"] or {}).items():
+        if column not in ('building', 'model', 'asset', 'technician'):
+            print("Ignoring unknown storeFilter field: " + str(column))
+            continue
+        query += " AND r." + column + " = ?"
+        params.append(value)
+    query += " ORDER BY r.created_at DESC, r.ticket_id DESC"
+
+    with ticketStoreLock:
+        records = openTicketStore().execute(query, params).fetchall()
+    logging("Exporting " + str(len(records)) + " replacements from " + ticketStoreFile)
+
+    rows = []
+    for record in records:
+        rows.append(ReplacementRow(
+            replacementDate=record[0], item=record[1], category=record[2] or "", subCategory=record[3] or "",
+            itemCategory=record[4] or "", model=record[5], building=record[6], srNumber=str(record[7]),
+            technician=record[8], asset=record[9], username=record[10],
+            description=' '.join((record[11] or "").splitlines()),
+            serial=record[12], warranty=record[13], aiDescription=record[14]))
+
+    # Rows stored before AI was turned on still need an AI description, these come from the AI cache where possible
+    missingAI = [row for row in rows if row.aiDescription is None]
+    if user_data["ai"] == "yes" and missingAI:
+        with stageTimer('ai'):
+            aiDescriptions = rephraseDescriptions([row.description for row in missingAI])
+        for row, aiDescription in zip(missingAI, aiDescriptions):
+            row.aiDescription = aiDescription
+
+    openOutput()
+    complete = False
+    try:
+        for start in range(0, len(rows), perPage):
+            with stageTimer('output_write'):
+                writeRows(rows[start:start + perPage])
+        complete = True
+    finally:
+        closeOutput(complete)
+
+
+@dataclass
+class ReplacementRow:
+    """One replacement Service Request as it moves through the export pipeline."""
+    replacementDate: str
+    item: str
+    category: str
+    subCategory: str
+    itemCategory: str
+    model: str
+    building: str
+    srNumber: str
+    technician: str
+    asset: str
+    username: str
+    description: str
+    serial: str = None
+    warranty: str = None
+    aiDescription: str = None
+
+    def values(self):
+        # Values in the same order as outputColumns
+        values = [self.replacementDate, self.item, self.category, self.subCategory, self.itemCategory, self.model, self.building, self.srNumber, self.technician, self.asset, self.serial, self.warranty, self.username, self.description]
+        if user_data["ai"] == "yes":
+            values.append(self.aiDescription)
+        return values
+
+
+@dataclass
+class ExportPage:
+    """A page of tickets and the rows made from them, passed between the export pipeline stages."""
+    page: int
+    ticketIds: list  # SRs on the page that have been fetched, only these are recorded as written
+    rows: list
+
+
+def fetchServiceRequest(ticket):
+    # Fetch the requested item for a single SR from its list page ticket, returns None if it isn't a replacement
+    ticketNumber = ticket["id"]
+    logging("Fetching SR " + str(ticketNumber))
+    itemsURL = base_url+"/"+str(ticketNumber)+"/requested_items"
+    row = None
+
+    # Rate limits and server errors are retried inside the Freshservice client
+    with stageTimer('requested_items'):
+        response = freshservice.get(itemsURL)
+    if response.status_code == 200:
+        try:
+            data = response.json()['requested_items'][0]  # Try to parse the JSON response
+            if user_data["store"] == "yes":
+                storeTicket(ticket, data)
+            if data.get('service_item_id') == 47:
+                custom_fields = data.get('custom_fields', {})
+
+                # The list page already has the categories, only fetch the full ticket if one is missing
+                ticketData = ticket
+                if any(field not in ticket for field in ('category', 'sub_category', 'item_category')):
+                    ticketDataURL = base_url+"/"+str(ticketNumber)
+                    with stageTimer('ticket_detail'):
+                        ticketDataResponse = freshservice.get(ticketDataURL)
+                    if ticketDataResponse.status_code == 200:
+                        ticketData = ticketDataResponse.json()['ticket']
+                    else:
+                        ticketData = {}
+                    ticketDataResponse.close()
+
+                row = ReplacementRow(
+                    replacementDate=data.get('created_at'),
+                    item=custom_fields.get('item'),
+                    category=ticketData.get('category') or "",
+                    subCategory=ticketData.get('sub_category') or "",
+                    itemCategory=ticketData.get('item_category') or "",
+                    model=custom_fields.get('model'),
+                    building=custom_fields.get('building'),
+                    srNumber=str(ticketNumber),
+                    technician=custom_fields.get('technician_initials'),
+                    asset=custom_fields.get('asset'),
+                    username=custom_fields.get('student_username'),
+                    description=' '.join((custom_fields.get('full_issue_description') or "").splitlines())
+                )
+
+        except json.decoder.JSONDecodeError:
+            print("Unable to parse the JSON response")
+            exitScript()
+        except IndexError:
+            logging("No Item Data found for " + str(ticketNumber))
+    elif response.status_code == 404:
+        logging("No Item Data found for " + str(ticketNumber))
+    else:
+        # Leaving the SR out would drop its row without anyone noticing, so stop the export the same as a failed ticket page
+        print("Error: " + str(response.status_code) + " fetching SR " + str(ticketNumber))
         response.close()
-        
-        logging("Service Request IDs:", service_request_ids)
-
-        assetNumbers = []
-        problemDescriptions = []
-        building = []
-        userName = []
-        technician = []
-        srNumber = []
-        replacementDate = []
-        item = []
-        itemModel = []
-        serialNumber = []
-        warrantyStatus = []
-
-        category = []
-        subCategory = []
-        itemCategory = []
-
-
-        # print("Fetching specific replacement data...")
-
-        for ticketNumber in tqdm(service_request_ids, desc="Fetching SR Data", unit="Service Request", leave=False, colour="blue"):
-            randomSleep()
-            logging(str(service_request_ids.index(ticketNumber)+1) + "/" + str(len(service_request_ids)))
-            itemsURL = base_url+"/"+str(ticketNumber)+"/requested_items"
-            # print(itemsURL)
-            reRunSrFetch = True
-
-            while reRunSrFetch:
-                response = requests.get(itemsURL, auth=(api_Key, password))
-                if response.status_code == 200:
-                    reRunSrFetch = False
-                    try:
-                        data = response.json()['requested_items'][0]  # Try to parse the JSON response
-                        # print(data)
-                        if data.get('service_item_id') == 47:
-                            custom_fields = data.get('custom_fields', {})
-                            assetNumbers.append(custom_fields.get('asset'))
-                            problemDescriptions.append(custom_fields.get('full_issue_description'))
-                            building.append(custom_fields.get('building'))
-                            userName.append(custom_fields.get('student_username'))
-                            technician.append(custom_fields.get('technician_initials'))
-                            srNumber.append(str(ticketNumber))
-                            replacementDate.append(data.get('created_at'))
-                            # print(replacementDate)
-                            item.append(custom_fields.get('item'))
-                            itemModel.append(custom_fields.get('model'))
-                            machineSerial = get_serial_from_asset_tag(custom_fields.get('asset'))
-                            serialNumber.append(machineSerial)
-                            if machineSerial != None and len(machineSerial) ==8:
-                                warrantyStatus.append(get_warranty_status(machineSerial))
-                            else:
-                                warrantyStatus.append("No Data for Lookup")
-
-                            ticketDataURL = base_url+"/"+str(ticketNumber)
-                            ticketDataResponse = requests.get(ticketDataURL, auth=(api_Key, password))
-                            if ticketDataResponse.status_code == 200:
-                                category.append(ticketDataResponse.json()['ticket']['category'])
-                                subCategory.append(ticketDataResponse.json()['ticket']['sub_category'])
-                                itemCategory.append(ticketDataResponse.json()['ticket']['item_category'])
-                            else:
-                                category.append("")
-                                subCategory.append("")
-                                itemCategory.append("")
-
-                
-
-
-
-                    except json.decoder.JSONDecodeError:
-                        print("Unable to parse the JSON response")
-                        data = []  # Set data as an empty list if parsing fails
-                        input("Press Enter to exit....")
-                        exit()
-                    except IndexError:
-                        logging("No Item Data found for " + str(ticketNumber))
-                        continue
+        exitScript()
+    response.close()
+
+    return row
+
+def fetchTicketPages(start_date, firstPage=1, end_date=None):
+    # Yields (page, Service Request tickets) for every ticket page updated from start_date up to end_date, starting at firstPage
+    # Dates are UTC, the same as the updated_at on the tickets
+    if user_data["serverFilter"] == "yes":
+        # Let Freshservice filter by type, the filter endpoint only compares whole days so the query
+        # is widened by a day on each side and the exact bounds are checked below
+        url = base_url + "/filter"
+        query = "type:'Service Request' AND updated_at:>'" + (start_date - timedelta(days=1)).strftime("%Y-%m-%d") + "'"
+        if end_date is not None:
+            query += " AND updated_at:<'" + (end_date + timedelta(days=1)).strftime("%Y-%m-%d") + "'"
+        params = {"query": "\"" + query + "\""}
+    else:
+        url = base_url
+        params = {"updated_since": start_date.strftime("%Y-%m-%dT%H:%M:%S")}
+    params["per_page"] = perPage
+
+    since = start_date.strftime("%Y-%m-%dT%H:%M:%S")
+    until = end_date.strftime("%Y-%m-%dT%H:%M:%S") if end_date is not None else None
+
+    def inWindow(ticket):
+        updated = (ticket.get("updated_at") or "")[:19]
+        return not updated or (updated >= since and (until is None or updated < until))
+
+    page = firstPage
+    linkedPages = False
+    progressBar = progress(desc="Processing Ticket Pages", unit="Page", initial=firstPage - 1)
+    while True:
+        params["page"] = page
+        with stageTimer('list_pages'):
+            response = freshservice.get(url, params=params)
+
+        if response.status_code == 200:
+            try:
+                data = response.json()['tickets']  # Try to parse the JSON response
+            except json.decoder.JSONDecodeError:
+                print("Unable to parse the JSON response")
+                exitScript()
+        else:
+            print("Error: " + str(response.status_code) + " fetching ticket page " + str(page))
+            exitScript()
+        response.close()
+        progressBar.update(1)
+        countMetric('ticket_pages')
 
-                else:
-                    # response.close()
-                    logging("Error: " + str(response.status_code))
-                    logging("Waiting for API cooldown")
-                    # time.sleep(30)
-                    coolDown(60)
-                response.close()
+        logging("Fetching Data from Freshservice page: "+  str(page))
+        yield page, [ticket for ticket in data if isinstance(ticket, dict) and ticket.get("type") == "Service Request" and inWindow(ticket)]
+
+        # Once Freshservice has sent a Link header, the page without a next link is the last one
+        # Without any Link headers a short page is taken as the last one instead
+        linkedPages = linkedPages or bool(response.headers.get('Link'))
+        if not data or 'next' not in response.links and (linkedPages or len(data) < perPage):
+            break
+        page += 1
+    progressBar.close()
+
+def utcNow():
+    # Naive UTC time, comparable with the updated_at on Freshservice tickets
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def loadSyncState():
+    # Sync state left by previous runs, see beginSyncRun
+    try:
+        with open(syncStateFile, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def saveSyncState():
+    # Write to a temporary file first so a crash mid-write can't corrupt the state
+    with open(syncStateFile + '.tmp', 'w') as f:
+        json.dump(syncState, f)
+    os.replace(syncStateFile + '.tmp', syncStateFile)
+
+def beginSyncRun(days):
+    # Work out where this export starts, resuming an interrupted run if there is one
+    global outputFilename, syncState
+
+    syncState = loadSyncState()
+    run = syncState.get('run')
+    # Parquet files can't be appended to, so an interrupted Parquet export always starts again
+    if (run is not None and user_data["resume"] == "yes" and
+        run.get('ai') == user_data["ai"] and
+        run.get('outputFormat') == user_data["outputFormat"] != 'parquet' and
+        os.path.exists(run['outputFilename'])):
+        outputFilename = run['outputFilename']
+        print("Resuming the interrupted export into " + outputFilename + " after page " + str(run['page']))
+        openOutput(append=True)
+        return run
+
+    now = utcNow()
+    if user_data["incremental"] == "yes" and syncState.get('highWaterMark'):
+        # Only fetch the tickets changed since the last run that finished
+        since = syncState['highWaterMark']
+        logging("Exporting tickets updated since " + since)
+    else:
+        since = (now - timedelta(days=days)).strftime("%Y-%m-%dT%H:%M:%S")
+        logging("Exporting data from past " + str(days) + " days")
+
+    openOutput()
+    run = {
+        'outputFilename': outputFilename,
+        'outputFormat': user_data["outputFormat"],
+        'ai': user_data["ai"],
+        'since': since,
+        # Anything updated after this is left for the next incremental run, the tickets aren't listed in updated order
+        # so a ticket updated while this run pages through the list could otherwise be missed
+        'highWaterMark': (now - syncClockSkew).strftime("%Y-%m-%dT%H:%M:%S"),
+        'page': 0,  # Last page written to the output file
+        'writtenIds': []  # Every SR fetched on the pages written so far
+    }
+    syncState['run'] = run
+    saveSyncState()
+    return run
+
+def recordSyncPage(run, exportPage):
+    # Called once a page is in the CSV so an interrupted run can carry on from the next one
+    run['page'] = exportPage.page
+    run['writtenIds'].extend(exportPage.ticketIds)
+    saveSyncState()
+
+def finishSyncRun(run):
+    # The next incremental run starts from when this run started, tickets updated right on the mark are exported again
+    if run.get('highWaterMark'):
+        syncState['highWaterMark'] = run['highWaterMark']
+    syncState.pop('run', None)
+    saveSyncState()
+
+def putStage(stageQueue, item, failed):
+    # Put an item on a pipeline queue, giving up if another stage has failed
+    while not failed.is_set():
+        try:
+            stageQueue.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+def getStage(stageQueue, failed):
+    # Take the next item from a pipeline queue, ending early if another stage has failed
+    while not failed.is_set():
+        try:
+            return stageQueue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return pipelineEnd
+
+def runStage(work, inbox, outbox, failed, errors):
+    # Pipeline stage thread, runs work on every ExportPage from inbox and passes the page on to outbox
+    # A stage with no inbox is the producer and work is a generator of ExportPages
+    try:
+        if inbox is None:
+            for item in work():
+                if failed.is_set():
+                    break
+                putStage(outbox, item, failed)
+        else:
+            while True:
+                item = getStage(inbox, failed)
+                if item is pipelineEnd:
+                    break
+                work(item)
+                putStage(outbox, item, failed)
+    except BaseException as e:
+        errors.append(e)
+        failed.set()
+    finally:
+        putStage(outbox, pipelineEnd, failed)
+
+def writeRows(rows):
+    # Add a page of rows to the open export file
+    logging("Writing " + str(len(rows)) + " rows to " + outputFilename)
+    try:
+        output.write([row.values() for row in rows])
+        countMetric('rows_written', len(rows))
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        print("Other error, please read details...")
+        exitScript()
 
-            
+def fetchReplacementData(days: int):
+    run = beginSyncRun(days)
+    start_date = datetime.strptime(run['since'][:19], "%Y-%m-%dT%H:%M:%S")
 
-        logging("Writing data to CSV...")
+    clearScreen()
+    complete = False
+    try:
+        runExport(start_date, run=run)
+        complete = True
+    finally:
+        closeOutput(complete)
+
+    # Only reached when every SR was fetched, a run that stopped keeps the old mark and carries on from its last page
+    finishSyncRun(run)
+
+def runExport(start_date, end_date=None, run=None):
+    # Export the replacements updated from start_date up to end_date into the open output
+    # With a sync run the export starts after its last written page and records each page it writes
+    global freshservice, lenovo
+    timeout = (float(user_data["connectTimeout"]), float(user_data["readTimeout"]))
+    freshservice = FreshserviceClient(user_data["apiKey"], int(user_data["concurrency"]) + 1, int(user_data["retries"]), timeout, int(user_data["rateLimit"]), rateBudget)
+    lenovo = LenovoWarrantyClient(user_data["lenovoURL"], user_data["lenovoKey"], int(user_data["lenovoWorkers"]), timeout)
+    firstPage = run['page'] + 1 if run is not None else 1
+    writtenIds = set(run['writtenIds']) if run is not None else set()
+
+    # Build the asset index before the SR workers start using it
+    with stageTimer('asset_index'):
+        loadAssetIndex()
+
+    # The export runs as a pipeline of stages connected by bounded queues so each stage works on a different page:
+    # ticket pages -> SR details -> serial and warranty -> AI descriptions (optional) -> CSV writer
+    # Each queue holds a few pages of rows, so memory stays the same however many days are exported
+    srExecutor = ThreadPoolExecutor(max_workers=max(1, int(user_data["concurrency"])))
+    warrantyExecutor = ThreadPoolExecutor(max_workers=max(1, int(user_data["lenovoWorkers"])))
+
+    def ticketPages():
+        for page, tickets in fetchTicketPages(start_date, firstPage, end_date):
+            # Empty pages still go through the pipeline so the sync state moves past them
+            tickets = [ticket for ticket in tickets if ticket["id"] not in writtenIds]
+            if tickets == []:
+                logging("No valid SRs on current page...")
+            else:
+                logging("Service Request IDs:", [ticket["id"] for ticket in tickets])
+            # The page carries its tickets as rows until fetchDetails turns them into replacements
+            yield ExportPage(page, [], tickets)
+
+    def fetchDetails(exportPage):
+        # Fetch the SRs in parallel, map keeps the results in the same order as the tickets on the page
+        # An SR only goes in ticketIds once its fetch has finished, one that fails stops the export before the page is written
+        tickets = exportPage.rows
+        countMetric('service_requests', len(tickets))
+        results = progress(srExecutor.map(fetchServiceRequest, tickets), desc="Fetching SR Data", unit="Service Request", leave=False, colour="blue", total=len(tickets))
+        exportPage.rows = []
+        for ticket, row in zip(tickets, results):
+            exportPage.ticketIds.append(ticket["id"])
+            if row is not None:
+                exportPage.rows.append(row)
+
+    def enrichRows(exportPage):
+        # Fill in the serial from the asset report, then look up each serial on the page once
+        rows = exportPage.rows
+        with stageTimer('asset_lookup'):
+            for row in rows:
+                row.serial = get_serial_from_asset_tag(row.asset)
+                row.warranty = "No Data for Lookup"
+        lookupRows = [row for row in rows if row.serial != None and len(row.serial) ==8]
+        with stageTimer('warranty'):
+            statuses = lookupWarranties([row.serial for row in lookupRows], warrantyExecutor)
+        for row in lookupRows:
+            row.warranty = statuses[row.serial]
+
+    def rephraseRows(exportPage):
+        rows = exportPage.rows
+        logging("Revising Descriptions With AI...")
+        with stageTimer('ai'):
+            aiDescriptions = rephraseDescriptions([row.description for row in rows])
+        for row, aiDescription in zip(rows, aiDescriptions):
+            row.aiDescription = aiDescription
+
+    stages = [ticketPages, fetchDetails, enrichRows]
+    if user_data["ai"] == "yes":
+        stages.append(rephraseRows)
+
+    failed = threading.Event()
+    errors = []
+    threads = []
+    inbox = None
+    for work in stages:
+        outbox = queue.Queue(maxsize=max(1, int(user_data["pipelineDepth"])))
+        thread = threading.Thread(target=runStage, args=(work, inbox, outbox, failed, errors), daemon=True)
+        thread.start()
+        threads.append(thread)
+        inbox = outbox
 
-        # Create a CSV file and write the data
-        logging(csvFilename)
+    try:
+        # The writer is the last stage and runs here
+        while True:
+            exportPage = getStage(inbox, failed)
+            if exportPage is pipelineEnd:
+                break
+            with stageTimer('output_write'):
+                writeRows(exportPage.rows)
+            if user_data["store"] == "yes":
+                with stageTimer('store_write'):
+                    storeRows(exportPage.rows)
+            if run is not None:
+                # The rows have to be in the file before the sync state says the page is done
+                output.flush()
+                recordSyncPage(run, exportPage)
+    except BaseException:
+        failed.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+        srExecutor.shutdown()
+        warrantyExecutor.shutdown()
+        freshservice.close()
+        lenovo.close()
+
+    # Stop the run the same way the stage that failed would have, the sync state keeps its place for the next run
+    if errors:
+        raise errors[0]
+
+def initShardWorker(data, budget, headlessRun):
+    # Runs once in each worker process of a sharded export
+    global rateBudget, headless, shardWorker
+
+    applyUserData(data)
+    rateBudget = budget
+    headless = headlessRun
+    shardWorker = True
+    if user_data["ai"] == "yes" and loadOllama():
+        waitForOllama(float(user_data["ollamaStartTimeout"]))
+        ollamaReady.set()
+
+def exportShard(shard):
+    # Export one time slice into its own JSONL file in a worker process, returning the file and the cache counts for it
+    # JSONL keeps empty values apart from empty strings, so the merged export is the same as an unsharded one
+    global outputFilename
+
+    start_date, end_date, outputFilename = shard
+    for stats in (warrantyCacheStats, aiCacheStats):
+        stats.update(hits=0, misses=0)
+    for metrics in runMetrics.values():
+        metrics.clear()
+
+    openOutput('jsonl')
+    try:
+        runExport(start_date, end_date)
+    except SystemExit:
+        # A worker process that exits never reports back to the pool, so turn it into an error the main process sees
+        raise RuntimeError("Export of tickets updated since " + str(start_date) + " stopped")
+    finally:
+        closeOutput()
+    return outputFilename, dict(warrantyCacheStats), dict(aiCacheStats), runMetrics
+
+def fetchShardedReplacementData(days: int):
+    # Split the window into shardDays slices, export them in parallel worker processes and merge them into one CSV
+    # The workers share one Freshservice rate budget so together they go no faster than a single export could
+    global aiCache
+
+    # updated_since has no upper bound, so without the filter endpoint every slice would page through to today
+    if user_data["serverFilter"] != "yes":
+        print("Sharded exports need the ticket filter endpoint, using it instead of serverFilter " + str(user_data["serverFilter"]))
+    workerData = dict(user_data, serverFilter="yes")
+
+    # Clear the AI cache once here rather than in every worker process, the workers then use it as normal
+    if user_data["ai"] == "yes" and user_data["aiCache"] == "clear":
+        openAICache().close()
+        aiCache = None  # Worker processes open their own connection
+        workerData["aiCache"] = "yes"
+
+    end_date = utcNow()
+    start_date = end_date - timedelta(days=days)
+    shardLength = timedelta(days=max(1, int(user_data["shardDays"])))
+
+    shards = []
+    sliceStart = start_date
+    while sliceStart < end_date:
+        sliceEnd = sliceStart + shardLength
+        # The newest slice has no end so tickets updated while the export runs aren't missed
+        shards.append((sliceStart, sliceEnd if sliceEnd < end_date else None, os.path.splitext(outputFilename)[0] + ".shard" + str(len(shards) + 1) + ".jsonl"))
+        sliceStart = sliceEnd
+    logging("Exporting " + str(len(shards)) + " slices of " + str(shardLength.days) + " days")
+
+    # Build the asset index sidecar once here so the workers only have to load it
+    loadAssetIndex()
+
+    clearScreen()
+    budget = sharedRateBudget(int(user_data["rateLimit"]))
+    workers = min(int(user_data["shardWorkers"]), len(shards))
+    try:
+        with multiprocessing.Pool(processes=workers, initializer=initShardWorker, initargs=(workerData, budget, headless)) as pool:
+            results = list(progress(pool.imap(exportShard, shards), desc="Exporting Slices", unit="Slice", total=len(shards)))
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        print("Other error, please read details...")
+        exitScript()
+
+    for shardFile, shardWarrantyStats, shardAIStats, shardMetrics in results:
+        for stats, shardStats in ((warrantyCacheStats, shardWarrantyStats), (aiCacheStats, shardAIStats)):
+            stats['hits'] += shardStats['hits']
+            stats['misses'] += shardStats['misses']
+        for stage, (seconds, calls) in shardMetrics['timers'].items():
+            timeMetric(stage, seconds, calls)
+        for (name, labels), count in shardMetrics['counters'].items():
+            # Rows are counted once they're merged, a Service Request can be in more than one slice
+            if name != 'rows_written':
+                countMetric(name, count, **dict(labels))
+
+    with stageTimer('merge_shards'):
+        mergeShards([shardFile for shardFile, _, _, _ in results])
+
+def mergeShards(shardFiles):
+    # Combine the slice files into the export, sorted by replacement date with each Service Request only once
+    columns = outputColumns()
+    mergedRows = {}
+    for shardFile in shardFiles:
+        with open(shardFile, mode='r', encoding='utf-8') as shard:
+            for line in shard:
+                record = json.loads(line)
+                mergedRows.setdefault(record["Service Request"], [record.get(column) for column in columns])
+
+    openOutput()
+    complete = False
+    try:
+        output.write(sorted(mergedRows.values(), key=lambda row: row[0] or ""))
+        complete = True
+    finally:
+        closeOutput(complete)
+    countMetric('rows_written', len(mergedRows))
+
+    for shardFile in shardFiles:
+        os.remove(shardFile)
+
+
+def prometheusLines(name, samples):
+    # One gauge in the Prometheus text format, samples are (labels, value) pairs
+    lines = ["# HELP replacement_export_" + name + " " + metricHelp[name], "# TYPE replacement_export_" + name + " gauge"]
+    for labels, value in samples:
+        labelText = ",".join(label + '="' + str(labelValue).replace('\\', '\\\\').replace('"', '\\"') + '"' for label, labelValue in labels)
+        lines.append("replacement_export_" + name + ("{" + labelText + "}" if labelText else "") + " " + str(value))
+    return lines
+
+def replaceFile(path, text):
+    # Write the whole file then swap it in, so a collector reading it never sees half a file
+    tempFile = path + '.tmp'
+    with open(tempFile, 'w', encoding='utf-8', newline='\n') as f:
+        f.write(text)
+    os.replace(tempFile, path)
+
+def writeRunMetrics(started, seconds, succeeded):
+    # Summarise the run into metricsFile as JSON and prometheusFile as a Prometheus textfile
+    with runMetricsLock:
+        timers = sorted((stage, stageSeconds, calls) for stage, (stageSeconds, calls) in runMetrics['timers'].items())
+        counters = {}
+        for (name, labels), count in sorted(runMetrics['counters'].items()):
+            counters.setdefault(name, []).append((labels, count))
+    for name in ('ticket_pages', 'service_requests', 'rows_written'):
+        counters.setdefault(name, [((), 0)])
+    serviceRequests = sum(count for _, count in counters['service_requests'])
+    rowsWritten = sum(count for _, count in counters['rows_written'])
+    ticketsPerSecond = round(serviceRequests / seconds, 2) if seconds > 0 else 0
+
+    if user_data["metricsFile"]:
+        summary = {
+            'started': datetime.fromtimestamp(started, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            'seconds': round(seconds, 3),
+            'success': succeeded,
+            'days': int(user_data["days"]),
+            'ai': user_data["ai"],
+            'serviceRequests': serviceRequests,
+            'rowsWritten': rowsWritten,
+            'ticketsPerSecond': ticketsPerSecond,
+            'stages': {stage: {'seconds': round(stageSeconds, 3), 'calls': calls} for stage, stageSeconds, calls in timers},
+            'counters': [{'name': name, 'labels': dict(labels), 'value': count} for name, samples in counters.items() for labels, count in samples],
+            'warrantyCache': dict(warrantyCacheStats),
+            'aiCache': dict(aiCacheStats)
+        }
+        try:
+            replaceFile(user_data["metricsFile"], json.dumps(summary, indent=4))
+            logging("Run metrics written to " + user_data["metricsFile"])
+        except OSError as e:
+            print("Unable to write " + user_data["metricsFile"] + ": " + str(e))
+
+    if user_data["prometheusFile"]:
+        lines = []
+        lines += prometheusLines('run_seconds', [((), round(seconds, 3))])
+        lines += prometheusLines('success', [((), 1 if succeeded else 0)])
+        lines += prometheusLines('last_run_timestamp_seconds', [((), int(started))])
+        lines += prometheusLines('tickets_per_second', [((), ticketsPerSecond)])
+        lines += prometheusLines('stage_seconds', [((('stage', stage),), round(stageSeconds, 3)) for stage, stageSeconds, _ in timers])
+        lines += prometheusLines('stage_calls', [((('stage', stage),), calls) for stage, _, calls in timers])
+        for name, samples in counters.items():
+            lines += prometheusLines(name, samples)
+        for name, key in (('cache_hits', 'hits'), ('cache_misses', 'misses')):
+            lines += prometheusLines(name, [((('cache', 'warranty'),), warrantyCacheStats[key]), ((('cache', 'ai'),), aiCacheStats[key])])
         try:
-            with open(csvFilename, mode='a', newline='') as csv_file:
-                writer = csv.writer(csv_file)
-            
-                # Write the header row (optional)
-                # writer.writerow(["Replacement Date", "Item", "Model", "Building", "Service Request", "Technician", "Asset Number", "Username", "Full Description"])
-            
-                # Write the data rows
-                for replaceDate, itemType, ticketCat, subCat, itemCat, itemTypeModel, replacementBuilding, replacementSRNum, replacementTech, replacementAsset, replacementSerial, replacementWarranty, replacementUsername, replacementDesc in tqdm(zip(replacementDate, item, category, subCategory, itemCategory, itemModel, building, srNumber, technician, assetNumbers, serialNumber, warrantyStatus, userName, problemDescriptions),desc="Writing Data to CSV", unit="Row", colour="yellow", leave=False, total=len(srNumber)):
-                    formattedString = ' '.join(replacementDesc.splitlines())
-                    # writer.writerow([asset, formattedString])
-                    try:
-                        if user_data["ai"] == "yes":
-                            logging("Revising Description With AI...")
-                            ai_description = rephraseText(formattedString)
-                            writer.writerow([replaceDate, itemType, ticketCat, subCat, itemCat, itemTypeModel, replacementBuilding, replacementSRNum, replacementTech, replacementAsset, replacementSerial, replacementWarranty, replacementUsername, formattedString, ai_description])
-                        else:
-                            writer.writerow([replaceDate, itemType, ticketCat, subCat, itemCat, itemTypeModel, replacementBuilding, replacementSRNum, replacementTech, replacementAsset, replacementSerial, replacementWarranty, replacementUsername, formattedString])
-                    except UnicodeEncodeError as e:
-                        # print("Encoding issue with " + serviceRequestNumber + " resolving issue...")
-                        problematic_character_index = e.start
-                        problematic_string = e.object
-                        cleaned_string = problematic_string[:problematic_character_index] + ' ' + problematic_string[problematic_character_index + 1:]
-                        writer.writerow([replaceDate, itemType, ticketCat, subCat, itemCat, itemTypeModel, replacementBuilding, replacementSRNum, replacementTech, replacementAsset, replacementSerial, replacementWarranty, replacementUsername, cleaned_string])
-                # for asset, description, build, tech, fullN in zip(assetNumbers, problemDescriptions, building, technician, fullName):
-                #     formattedString = ' '.join(description.splitlines())
-                #     writer.writerow([asset, formattedString, build, tech, fullN])
-        except PermissionError:
-            print("Please close or delete the output_data.csv file...")
-            input("Press Enter to exit....")
-            exit()
-        except Exception as e:
-            print(f"An error occurred: {e}")
-            print("Other error, please read details...")
-            input("Press Enter to exit....")
-            exit()
+            replaceFile(user_data["prometheusFile"], "\n".join(lines) + "\n")
+            logging("Prometheus metrics written to " + user_data["prometheusFile"])
+        except OSError as e:
+            print("Unable to write " + user_data["prometheusFile"] + ": " + str(e))
 
 
 # api_key = readAPIKeyFromFile()
 
-# Try to start ollama
-if checkOllama():
-    logging("Local Llama is available")
-    startOllama()
-    
+def parseArguments(argv=None):
+    parser = argparse.ArgumentParser(description="Export replacement Service Requests from Freshservice to a CSV, JSONL or Parquet file.",
+                                     epilog="Any setting can also be given as an environment variable, e.g. EXPORT_API_KEY or EXPORT_WARRANTY_CACHE_DAYS.")
+    parser.add_argument('--headless', action='store_true', help="never prompt or pause, this is the default when there is no console to answer prompts")
+    parser.add_argument('--config', default=userDataFile, help="settings file to read, default %(default)s")
+    parser.add_argument('--output', help="file to write, default output_data_<timestamp> with the extension for outputFormat (.csv, .jsonl or .parquet)")
+    parser.add_argument('--days', type=int, help="days of Service Requests to export")
+    parser.add_argument('--ai', choices=['yes', 'no'], help="rephrase descriptions with AI")
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help="override any setting from user_data.json for this run, can be repeated")
+    args = parser.parse_args(argv)
+
+    settings = []
+    for setting in args.set:
+        key, separator, value = setting.partition('=')
+        if not separator or (key not in questions and key not in advancedSettings):
+            parser.error("unknown setting '" + setting + "', use one of the keys in user_data.json as KEY=VALUE")
+        settings.append((key, value))
+    args.set = settings
+    return args
+
+def main(argv=None):
+    global headless, userDataFile, outputFilename
+
+    args = parseArguments(argv)
+    # Scheduled runs from cron or a task scheduler have no console to answer prompts, so they run headless
+    headless = args.headless or os.environ.get('EXPORT_HEADLESS') == 'yes' or sys.stdin is None or not sys.stdin.isatty()
+    userDataFile = args.config
+
+    overrides = settingOverrides(args)
+    applyUserData(headlessUserData(overrides) if headless else askUserData(overrides))
+    outputFilename = args.output or defaultOutputFilename()
+
+    # Try to start ollama
+    if checkOllama():
+        logging("Local Llama is available")
+        startOllama()
+
+    # Get Ollama and the model ready in the background while the export starts
+    if user_data["ai"] == "yes":
+        if loadOllama():
+            threading.Thread(target=prepareOllama, daemon=True).start()
+        else:
+            user_data["ai"] = "no"
+
+    # Run metrics are written however the export ends, so a stopped run still shows up as a failure
+    started = time.time()
+    startedClock = time.monotonic()
+    succeeded = False
+    try:
+        if user_data["source"] == "store":
+            exportFromStore(int(user_data["days"]))
+        elif int(user_data["shardWorkers"]) > 1:
+            fetchShardedReplacementData(int(user_data["days"]))
+        else:
+            fetchReplacementData(int(user_data["days"]))
+        succeeded = True
+    finally:
+        writeRunMetrics(started, time.monotonic() - startedClock, succeeded)
+    if checkOllama():
+        terminate_exe()
+    print("Warranty cache: " + str(warrantyCacheStats['hits']) + " hits, " + str(warrantyCacheStats['misses']) + " misses")
+    if user_data["ai"] == "yes":
+        print("AI description cache: " + str(aiCacheStats['hits']) + " hits, " + str(aiCacheStats['misses']) + " misses")
+    print("Output file generated: " + str(outputFilename))
+    if not headless:
+        input("Press Enter to exit....")
 
-createCSVFile()
-fetchReplacementData(int(user_data["days"]))
-if checkOllama():
-    terminate_exe()
-print("Output file generated: " + str(csvFilename))
-input("Press Enter to exit....")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
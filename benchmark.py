@@ -0,0 +1,493 @@
+import argparse
+import csv
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# Offline benchmark for FetchReplacementData.py
+# Local stand-ins for Freshservice, Lenovo and Ollama serve synthetic data, then each scenario runs
+# fetchReplacementData end to end in its own process and reports throughput, API calls, latency and peak memory
+
+# Fixed scenarios: (name, days exported, AI rephrasing)
+scenarios = [
+    ('30d', 30, 'no'),
+    ('30d-ai', 30, 'yes'),
+    ('90d', 90, 'no'),
+    ('90d-ai', 90, 'yes'),
+    ('365d', 365, 'no'),
+    ('365d-ai', 365, 'yes')
+]
+
+# Synthetic issue descriptions, a few of each so AI batching and de-duplication have something to do
+descriptionParts = [
+    "Screen cracked", "Keyboard missing keys", "Will not power on", "Hinge broken", "Charging port loose",
+    "Trackpad not clicking", "Liquid spilled on keyboard", "Camera not working", "Battery swollen", "Dropped in hallway"
+]
+descriptionDetails = ["after being dropped", "student says it happened at home", "reported by teacher", "left in backpack", "écran fissuré – “dropped” 📱", ""]
+
+models = ["300e", "100e", "500w"]
+buildings = ["HS", "MS", "ES1", "ES2"]
+
+
+def endpointName(path):
+    # Group requests by the API call they make so counts and latencies can be compared across runs
+    if path.endswith('/tickets/filter'):
+        return 'freshservice tickets/filter'
+    if path.endswith('/tickets'):
+        return 'freshservice tickets'
+    if path.endswith('/requested_items'):
+        return 'freshservice requested_items'
+    if re.search(r'/tickets/\d+$', path):
+        return 'freshservice ticket'
+    if path.endswith('/warranty'):
+        return 'lenovo warranty'
+    if path.startswith('/api/'):
+        return 'ollama ' + path[len('/api/'):]
+    return path
+
+def percentile(values, p):
+    # Nearest rank percentile, None when there is nothing to rank
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))]
+
+
+class StubData:
+    """Synthetic tickets, requested items and asset report, the same for every run with the same seed."""
+
+    def __init__(self, ticketsPerDay, seed, now):
+        rng = random.Random(seed)
+        self.tickets = []
+        self.items = {}
+        for number in range(1, 366 * ticketsPerDay + 1):
+            updated = now - timedelta(seconds=rng.uniform(0, 365 * 86400))
+            ticket = {
+                "id": number,
+                "type": "Service Request" if rng.random() < 0.7 else "Incident",
+                "category": "Hardware",
+                "sub_category": "Chromebook",
+                "item_category": "Replacement",
+                "updated_at": updated.strftime("%Y-%m-%dT%H:%M:%SZ")
+            }
+            self.tickets.append(ticket)
+            # Most Service Requests are replacements (service item 47), the rest are other catalog items
+            self.items[number] = {
+                "service_item_id": 47 if rng.random() < 0.8 else 12,
+                "created_at": (updated - timedelta(hours=rng.uniform(0, 48))).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "custom_fields": {
+                    "item": "Chromebook",
+                    "model": rng.choice(models),
+                    "building": rng.choice(buildings),
+                    "technician_initials": rng.choice(["AB", "CD", "EF"]),
+                    "asset": "A%06d" % number,
+                    "student_username": "student%d" % rng.randrange(1, 5000),
+                    "full_issue_description": (rng.choice(descriptionParts) + " " + rng.choice(descriptionDetails)).strip()
+                }
+            }
+        # Lists come back newest first, the same as Freshservice
+        self.tickets.sort(key=lambda ticket: ticket["updated_at"], reverse=True)
+        self.serviceRequests = [ticket for ticket in self.tickets if ticket["type"] == "Service Request"]
+        self.byId = {ticket["id"]: ticket for ticket in self.tickets}
+        # One in ten assets has no serial in the report so some rows skip the warranty lookup
+        self.serials = {"A%06d" % number: "PF%06d" % number for number in self.byId if number % 10}
+        self.warrantyEnds = {serial: (now + timedelta(days=rng.randint(-400, 900))).strftime("%Y-%m-%dT%H:%M:%SZ") for serial in self.serials.values()}
+
+    def writeAssetReport(self, path):
+        with open(path, mode='w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["Asset Tag", "Serial", "Model"])
+            for asset, serial in self.serials.items():
+                writer.writerow([asset, serial, "300e"])
+
+
+class StubStats:
+    """Calls and error responses served by the stand-in servers, by endpoint."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = {}
+            self.errors = {}
+
+    def record(self, endpoint, status):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            if status >= 400:
+                key = endpoint + " " + str(status)
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.calls), dict(self.errors)
+
+
+class StubServer:
+    """One local stand-in API on its own port, answering with the given latency, rate limit and error rate."""
+
+    def __init__(self, service, data, stats, latency, errorRate, rateLimit, seed):
+        self.service = service
+        self.data = data
+        self.stats = stats
+        self.latency = latency
+        self.errorRate = errorRate
+        self.rateLimit = rateLimit
+        self.random = random.Random(seed)
+        self.randomLock = threading.Lock()
+        self.window = deque()  # Times of the calls made in the last minute, for the rate limit headers
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handlerClass())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:" + str(self.server.server_address[1])
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def chance(self):
+        with self.randomLock:
+            return self.random.random()
+
+    def delay(self):
+        # Simulated network and server time, +/- 50% so calls don't all finish together
+        if self.latency > 0:
+            time.sleep(self.latency * (0.5 + self.chance()))
+
+    def rateLimitHeaders(self):
+        # Freshservice style per-minute budget, returns (headers, seconds to wait) where the wait is 0 unless the budget is spent
+        now = time.monotonic()
+        with self.randomLock:
+            while self.window and self.window[0] <= now - 60:
+                self.window.popleft()
+            if len(self.window) >= self.rateLimit:
+                retryAfter = max(1, int(self.window[0] + 60 - now + 1))
+                return {"X-Ratelimit-Total": str(self.rateLimit), "X-Ratelimit-Remaining": "0", "Retry-After": str(retryAfter)}, retryAfter
+            self.window.append(now)
+            return {"X-Ratelimit-Total": str(self.rateLimit), "X-Ratelimit-Remaining": str(self.rateLimit - len(self.window))}, 0
+
+    def handlerClass(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Keep-alive, the same as the real APIs
+            disable_nagle_algorithm = True  # Headers and body are written separately, don't hold the body back for an ACK
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, endpoint, status, body, headers=None):
+                content = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(content)
+                stub.stats.record(endpoint, status)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                endpoint = endpointName(url.path)
+                stub.delay()
+                if stub.service == 'freshservice':
+                    headers, retryAfter = stub.rateLimitHeaders()
+                    if retryAfter:
+                        return self.reply(endpoint, 429, {"message": "rate limited"}, headers)
+                    if stub.chance() < stub.errorRate:
+                        return self.reply(endpoint, 503, {"message": "unavailable"}, headers)
+                    return self.freshservice(url, endpoint, headers)
+                if stub.service == 'lenovo':
+                    if stub.chance() < stub.errorRate:
+                        return self.reply(endpoint, 500, {"message": "error"})
+                    return self.lenovo(url, endpoint)
+                if url.path == '/api/version':
+                    return self.reply(endpoint, 200, {"version": "0.0.0"})
+                self.reply(endpoint, 404, {})
+
+            def freshservice(self, url, endpoint, headers):
+                query = parse_qs(url.query)
+                match = re.match(r'/api/v2/tickets/(\d+)(/requested_items)?$', url.path)
+                if match:
+                    number = int(match.group(1))
+                    if number not in stub.data.byId:
+                        return self.reply(endpoint, 404, {}, headers)
+                    if match.group(2):
+                        return self.reply(endpoint, 200, {"requested_items": [stub.data.items[number]]}, headers)
+                    return self.reply(endpoint, 200, {"ticket": stub.data.byId[number]}, headers)
+
+                if url.path == '/api/v2/tickets/filter':
+                    # Only the parts of the filter query the export uses: Service Requests updated between two days
+                    filterQuery = query.get("query", [""])[0]
+                    tickets = stub.data.serviceRequests
+                    after = re.search(r"updated_at:>'([\d-]+)'", filterQuery)
+                    before = re.search(r"updated_at:<'([\d-]+)'", filterQuery)
+                    if after:
+                        tickets = [ticket for ticket in tickets if ticket["updated_at"][:10] > after.group(1)]
+                    if before:
+                        tickets = [ticket for ticket in tickets if ticket["updated_at"][:10] < before.group(1)]
+                elif url.path == '/api/v2/tickets':
+                    tickets = stub.data.tickets
+                    if "updated_since" in query:
+                        tickets = [ticket for ticket in tickets if ticket["updated_at"][:19] >= query["updated_since"][0]]
+                else:
+                    return self.reply(endpoint, 404, {}, headers)
+
+                page = int(query.get("page", ["1"])[0])
+                perPage = min(100, int(query.get("per_page", ["30"])[0]))
+                if page * perPage < len(tickets):
+                    headers["Link"] = '<' + stub.url + url.path + '?page=' + str(page + 1) + '>; rel="next"'
+                self.reply(endpoint, 200, {"tickets": tickets[(page - 1) * perPage:page * perPage]}, headers)
+
+            def lenovo(self, url, endpoint):
+                serials = [serial for serial in parse_qs(url.query).get("Serial", [""])[0].split(",") if serial]
+                replies = []
+                for serial in serials:
+                    end = stub.data.warrantyEnds.get(serial.upper())
+                    if end is None:
+                        replies.append({"Serial": serial, "InWarranty": False, "Warranty": []})
+                    else:
+                        replies.append({"Serial": serial, "InWarranty": end > datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                                        "Warranty": [{"Start": "2022-01-01T00:00:00Z", "End": end}]})
+                self.reply(endpoint, 200, replies[0] if len(replies) == 1 else replies)
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                endpoint = endpointName(url.path)
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                stub.delay()
+                if url.path == '/api/chat':
+                    # Rephrase by tagging the statement, or every statement of a JSON batch prompt
+                    statement = body["messages"][-1]["content"]
+                    if body.get("format") == "json":
+                        content = json.dumps({"rephrased": ["Rephrased: " + text for text in json.loads(statement)]})
+                    else:
+                        content = "Rephrased: " + statement
+                    return self.reply(endpoint, 200, {"model": body.get("model"), "created_at": "2026-01-01T00:00:00Z",
+                                                      "message": {"role": "assistant", "content": content}, "done": True})
+                if url.path == '/api/generate':
+                    return self.reply(endpoint, 200, {"model": body.get("model"), "created_at": "2026-01-01T00:00:00Z", "response": "", "done": True})
+                self.reply(endpoint, 404, {})
+
+        return Handler
+
+
+def timeClientCalls(latencies):
+    # Record how long every HTTP call takes from the export's side, requests for Freshservice and Lenovo, httpx for Ollama
+    import requests
+
+    def timed(send):
+        def wrapper(self, request, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return send(self, request, *args, **kwargs)
+            finally:
+                latencies.setdefault(endpointName(urlparse(str(request.url)).path), []).append(time.perf_counter() - start)
+        return wrapper
+
+    requests.Session.send = timed(requests.Session.send)
+    try:
+        import httpx
+        httpx.Client.send = timed(httpx.Client.send)
+    except ImportError:
+        pass
+
+def runScenario(configFile):
+    # Runs in a fresh process for each scenario so no caches or module state carry over between them
+    import tracemalloc
+
+    with open(configFile, 'r') as f:
+        config = json.load(f)
+    os.chdir(config['workDir'])
+    os.environ['OLLAMA_HOST'] = config['ollamaHost']
+    sys.path.insert(0, config['scriptDir'])
+    import FetchReplacementData
+
+    latencies = {}
+    timeClientCalls(latencies)
+    FetchReplacementData.headless = True
+    FetchReplacementData.applyUserData(config['settings'])
+    FetchReplacementData.outputFilename = 'benchmark' + FetchReplacementData.outputTypes[config['settings']['outputFormat']].extension
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    if config['settings']['ai'] == 'yes' and FetchReplacementData.loadOllama():
+        threading.Thread(target=FetchReplacementData.prepareOllama, daemon=True).start()
+    FetchReplacementData.fetchReplacementData(int(config['settings']['days']))
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    rows = sum(count for (name, _), count in FetchReplacementData.runMetrics['counters'].items() if name == 'rows_written')
+
+    with open(config['resultFile'], 'w') as f:
+        json.dump({'seconds': elapsed, 'rows': rows, 'peakMemory': peak, 'latencies': latencies}, f)
+
+
+def benchmarkSettings(args, stubs, days, ai):
+    # Shipped defaults for every advanced setting, pointed at the stand-ins, with any --set overrides on top
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import FetchReplacementData
+
+    settings = dict(FetchReplacementData.advancedSettings)
+    settings.update({
+        'freshserviceBaseURL': stubs['freshservice'].url + "/",
+        'apiKey': 'benchmark',
+        'lenovoKey': 'benchmark',
+        'days': str(days),
+        'ai': ai,
+        'model': 'benchmark',
+        'debug': 'no',
+        'lenovoURL': stubs['lenovo'].url + "/v2.5/warranty",
+        'incremental': 'no',
+        'resume': 'no',
+        'source': 'api',
+        'shardWorkers': 1
+    })
+    for setting in args.set:
+        key, separator, value = setting.partition('=')
+        if not separator or key not in settings:
+            sys.exit("Unknown setting '" + setting + "', use one of the keys in user_data.json as KEY=VALUE")
+        settings[key] = FetchReplacementData.parseSetting(key, value)
+    return settings
+
+def runBenchmark(args):
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    data = StubData(args.tickets_per_day, args.seed, now)
+    stats = StubStats()
+    stubs = {
+        'freshservice': StubServer('freshservice', data, stats, args.freshservice_latency / 1000, args.error_rate, args.rate_limit, args.seed),
+        'lenovo': StubServer('lenovo', data, stats, args.lenovo_latency / 1000, args.error_rate, args.rate_limit, args.seed + 1),
+        'ollama': StubServer('ollama', data, stats, args.ai_latency / 1000, 0, args.rate_limit, args.seed + 2)
+    }
+
+    selected = [scenario for scenario in scenarios if not args.scenarios or scenario[0] in args.scenarios]
+    unknown = set(args.scenarios or []) - set(scenario[0] for scenario in scenarios)
+    if unknown:
+        sys.exit("Unknown scenarios: " + ", ".join(sorted(unknown)) + ", choose from " + ", ".join(scenario[0] for scenario in scenarios))
+
+    results = []
+    try:
+        for name, days, ai in selected:
+            workDir = tempfile.mkdtemp(prefix='benchmark-' + name + '-')
+            try:
+                data.writeAssetReport(os.path.join(workDir, 'assets-report.csv'))
+                config = {
+                    'workDir': workDir,
+                    'scriptDir': os.path.dirname(os.path.abspath(__file__)),
+                    'ollamaHost': stubs['ollama'].url,
+                    'resultFile': os.path.join(workDir, 'result.json'),
+                    'settings': benchmarkSettings(args, stubs, days, ai)
+                }
+                with open(os.path.join(workDir, 'config.json'), 'w') as f:
+                    json.dump(config, f)
+
+                print("Running " + name + "...", flush=True)
+                stats.reset()
+                child = subprocess.run([sys.executable, os.path.abspath(__file__), '--scenario-config', os.path.join(workDir, 'config.json')],
+                                       stdout=None if args.verbose else subprocess.DEVNULL, stdin=subprocess.DEVNULL)
+                if child.returncode != 0:
+                    print(name + " failed with exit status " + str(child.returncode))
+                    continue
+                with open(config['resultFile'], 'r') as f:
+                    result = json.load(f)
+            finally:
+                if not args.keep:
+                    shutil.rmtree(workDir, ignore_errors=True)
+                else:
+                    print("Kept " + workDir)
+
+            calls, errors = stats.snapshot()
+            # Every Service Request in the window has its requested items fetched once, retried calls aside
+            tickets = calls.get('freshservice requested_items', 0) - sum(count for error, count in errors.items() if error.startswith('freshservice requested_items '))
+            results.append({
+                'scenario': name,
+                'days': days,
+                'ai': ai,
+                'seconds': round(result['seconds'], 3),
+                'tickets': tickets,
+                'rows': result['rows'],
+                'ticketsPerSecond': round(tickets / result['seconds'], 2) if result['seconds'] else None,
+                'peakMemoryMB': round(result['peakMemory'] / 1048576, 2),
+                'calls': calls,
+                'errors': errors,
+                'latencyMs': {
+                    endpoint: {
+                        'p50': round(percentile(times, 50) * 1000, 1),
+                        'p95': round(percentile(times, 95) * 1000, 1)
+                    } for endpoint, times in sorted(result['latencies'].items())
+                }
+            })
+    finally:
+        for stub in stubs.values():
+            stub.close()
+    return results
+
+def printResults(results):
+    print("")
+    print("%-10s %8s %6s %9s %10s %9s" % ("Scenario", "Tickets", "Rows", "Seconds", "Tickets/s", "Peak MB"))
+    for result in results:
+        print("%-10s %8d %6d %9.2f %10.2f %9.2f" % (result['scenario'], result['tickets'], result['rows'], result['seconds'],
+                                                   result['ticketsPerSecond'] or 0, result['peakMemoryMB']))
+
+    for result in results:
+        print("")
+        print(result['scenario'] + ":")
+        print("    %-30s %7s %9s %9s" % ("Endpoint", "Calls", "p50 ms", "p95 ms"))
+        for endpoint, calls in sorted(result['calls'].items()):
+            latency = result['latencyMs'].get(endpoint, {})
+            print("    %-30s %7d %9s %9s" % (endpoint, calls, latency.get('p50', '-'), latency.get('p95', '-')))
+        for error, count in sorted(result['errors'].items()):
+            print("    %-30s %7d" % (error, count))
+
+def parseArguments(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark FetchReplacementData.py against local stand-ins for Freshservice, Lenovo and Ollama.")
+    parser.add_argument('scenarios', nargs='*', help="scenarios to run, default all of: " + ", ".join(scenario[0] for scenario in scenarios))
+    parser.add_argument('--tickets-per-day', type=int, default=10, help="synthetic tickets updated per day, default %(default)s")
+    parser.add_argument('--freshservice-latency', type=float, default=50, help="average Freshservice response time in ms, default %(default)s")
+    parser.add_argument('--lenovo-latency', type=float, default=100, help="average Lenovo response time in ms, default %(default)s")
+    parser.add_argument('--ai-latency', type=float, default=200, help="average Ollama response time in ms, default %(default)s")
+    parser.add_argument('--rate-limit', type=int, default=5000, help="Freshservice calls allowed per minute, default %(default)s")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of Freshservice and Lenovo calls that fail with a server error, default %(default)s")
+    parser.add_argument('--seed', type=int, default=1, help="seed for the synthetic data, latency and errors, default %(default)s")
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help="override a setting for every scenario, can be repeated")
+    parser.add_argument('--json', help="also write the results to this JSON file")
+    parser.add_argument('--keep', action='store_true', help="keep each scenario's working directory")
+    parser.add_argument('--verbose', action='store_true', help="show the export's own output")
+    parser.add_argument('--scenario-config', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parseArguments(argv)
+    if args.scenario_config:
+        runScenario(args.scenario_config)
+        return
+
+    results = runBenchmark(args)
+    printResults(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+        print("")
+        print("Results written to " + args.json)
+
+if __name__ == "__main__":
+    main()